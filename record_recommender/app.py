@@ -26,6 +26,7 @@
 
 from __future__ import absolute_import, print_function
 
+import json
 import logging
 import logging.config
 import os
@@ -33,11 +34,12 @@ import signal
 import time
 from multiprocessing import Manager, Pool
 
+import numpy as np
 import yaml
 
-from .fetcher import ElasticsearchFetcher
-from .recommender import GraphRecommender
-from .storage import FileStore
+from .progress import BuildProgress, ProgressReporter
+from .storage import BackgroundWriter, FileStore
+from .utils import get_shard
 
 _reco = None
 _store = None
@@ -92,78 +94,257 @@ class RecordRecommender(object):
         self.store = FileStore(self.config)
         self.logger = logging.getLogger('app.RecordRecommender')
 
-    def fetch_weeks(self, weeks, overwrite=False):
-        """Fetch and cache the requested weeks."""
+    def fetch_weeks(self, weeks, overwrite=False, concurrency=None,
+                    incremental=False):
+        """
+        Fetch and cache the requested weeks.
+
+        :param concurrency: Number of streams fetched in parallel, defaults
+            to ``fetch_concurrency`` of the elasticsearch config.
+        :param incremental: Append the events newer than the ones of
+            complete week files instead of fetching them again.
+        :returns: List with the (year, week, prefix) of failed fetches.
+        """
+        from .fetcher import ElasticsearchFetcher
+
         esf = ElasticsearchFetcher(self.store, self.config)
+        if concurrency is None:
+            concurrency = (self.config.get('elasticsearch') or {}).get(
+                'fetch_concurrency', 1)
+        if concurrency > 1:
+            failed = esf.fetch_many(weeks, overwrite, concurrency,
+                                    incremental)
+            for year, week, prefix in failed:
+                self.logger.error("Fetch failed {} {}-{}".format(prefix, year,
+                                                                 week))
+            return failed
         for year, week in weeks:
             print("Fetch {}-{}".format(year, week))
-            esf.fetch(year, week, overwrite)
+            esf.fetch(year, week, overwrite, incremental)
+        return []
+
+    def import_events(self, paths, processes=1, append=False,
+                      complete=False):
+        """
+        Import exported events into the week files.
+
+        :param paths: NDJSON files of hits, optionally gzip compressed.
+        :param processes: Number of files imported in parallel.
+        :param append: Append to the week files instead of replacing them.
+        :param complete: The files hold all events of their weeks, the
+            weeks are not fetched again.
+        :returns: List with the imported (prefix, year, week) files.
+        """
+        from .importer import EventImporter
+
+        importer = EventImporter(self.store, self.config)
+        return importer.import_files(paths, processes, append, complete)
+
+    def create_all_recommendations(self, cores, ip_views=False, shard=None,
+                                   max_duration=None):
+        """Calculate the recommendations for all records.
 
-    def create_all_recommendations(self, cores, ip_views=False):
-        """Calculate the recommendations for all records."""
+        The most viewed records are built first.
+
+        :param shard: Tuple ``(index, total)`` to build only the records of
+            one shard, see :func:`record_recommender.utils.get_shard`.
+        :param max_duration: Seconds after which no new record is started.
+        :returns: The summary of the build, ``failed`` counts the records
+            which could not be calculated or written.
+        """
         global _store
         _store = self.store
-        _create_all_recommendations(cores, ip_views, self.config)
+        return _create_all_recommendations(cores, ip_views, self.config,
+                                           shard=shard,
+                                           max_duration=max_duration)
+
+    def verify_recommendations(self, ip_views=False, shards=1,
+                               batch_size=1000):
+        """
+        Verify that all records have an up to date recommendation.
+
+        The records are read from the profiles, the recommendations from the
+        recommendation store.
+
+        Returns: Dictionary with the missing and outdated records per shard.
+        """
+        records = set()
+        profiles = ['Profiles', 'Profiles_IP'] if ip_views else ['Profiles']
+        for profile in profiles:
+            data = self.store.get_user_profiles(profile)
+            if hasattr(data, 'get_columns'):
+                records.update(np.unique(data.get_columns()[1]).tolist())
+                continue
+            for row in data.get_user_views():
+                records.add(int(row[1]))
+        records = sorted(records)
+
+        reco_version = self.config.get('recommendation_version', 0)
+        redis = self.store.get_recommendation_store()
+        missing = []
+        outdated = []
+        for i in range(0, len(records), batch_size):
+            batch = records[i:i + batch_size]
+            for recid, data in redis.get_many(batch).items():
+                if data is None:
+                    missing.append(recid)
+                elif data.get('version') != reco_version:
+                    outdated.append(recid)
 
+        report = {'records': len(records),
+                  'missing': sorted(missing),
+                  'outdated': sorted(outdated),
+                  'shards': {}}
+        for index in range(shards):
+            report['shards'][index] = {
+                'missing': len([r for r in missing
+                                if get_shard(r, shards) == index]),
+                'outdated': len([r for r in outdated
+                                 if get_shard(r, shards) == index]),
+            }
+        self.logger.info("Verified %s records: %s missing, %s outdated",
+                         len(records), len(missing), len(outdated))
+        return report
 
-def _create_all_recommendations(cores, ip_views=False, config=None):
+
+def _get_priorities(build_config):
+    """Get the priority of each record, higher priorities are built first.
+
+    By default the number of views gathered in the profiles is used, a JSON
+    file mapping record ids to priorities can be configured instead.
+    """
+    priority_file = build_config.get('priority_file')
+    if priority_file:
+        with open(priority_file, 'r') as f:
+            return dict((int(recid), priority)
+                        for recid, priority in json.load(f).items())
+    if build_config.get('priority', 'views') == 'views':
+        return _reco.all_records
+    return None
+
+
+def _create_all_recommendations(cores, ip_views=False, config=None,
+                                shard=None, max_duration=None):
     """Calculate all recommendations in multiple processes."""
     global _reco, _store
+    from .recommender import GraphRecommender
 
     _reco = GraphRecommender(_store)
     _reco.load_profile('Profiles')
     if ip_views:
         _reco.load_profile('Profiles_IP')
 
+    records = list(_reco.all_records.keys())
+    if shard:
+        index, total = shard
+        records = [r for r in records if get_shard(r, total) == index]
+        logger.info("Build shard {}/{}".format(index, total))
+
+    build_config = config.get('build') or {}
+    priorities = _get_priorities(build_config)
+    if priorities is not None:
+        # The workers pop from the end of the list.
+        records.sort(key=lambda recid: (priorities.get(recid, 0), recid))
+
     manager = Manager()
-    record_list = manager.list(_reco.all_records.keys())
-    # record_list = manager.list(list(_reco.all_records.keys())[:10])
-    num_records = len(_reco.all_records.keys())
+    record_list = manager.list(records)
+    num_records = len(records)
     logger.info("Recommendations to build: {}".format(num_records))
 
-    start = time.time()
     reco_version = config.get('recommendation_version', 0)
-    done_records = num_records
-    if cores <= 1:
-        _create_recommendations(0, record_list, reco_version)
-    else:
-        try:
-            pool = Pool(cores)
+    max_duration = max_duration or build_config.get('max_duration')
+    deadline = time.time() + max_duration if max_duration else None
+    progress = BuildProgress(manager, num_records)
+    reporter = ProgressReporter(progress,
+                                build_config.get('report_interval', 60))
+    reporter.start()
+    interrupted = False
+    pool = None
+    try:
+        if cores <= 1:
+            _create_recommendations(0, record_list, reco_version, progress,
+                                    build_config, deadline)
+        else:
+            pool = Pool(cores, _ignore_interrupts)
             multiple_results = [pool.apply_async(_create_recommendations,
-                                (i, record_list, reco_version))
+                                (i, record_list, reco_version, progress,
+                                 build_config, deadline))
                                 for i in range(cores)]
             # Wait for all processes to exit
             [res.get() for res in multiple_results]
-        except KeyboardInterrupt:
-            print("Caught KeyboardInterrupt, terminating workers")
-            # TODO: Update done_records.
+            pool.close()
+            pool.join()
+    except KeyboardInterrupt:
+        print("Caught KeyboardInterrupt, terminating workers")
+        interrupted = True
+        if pool is not None:
             pool.terminate()
             pool.join()
+    finally:
+        reporter.stop()
 
-    duration = time.time() - start
-    logger.info("Time {} for {} recommendations".format(duration,
-                                                        done_records))
+    report_path = build_config.get(
+        'report_path', '{}build_report.json'.format(_store.base_path))
+    if shard:
+        root, ext = os.path.splitext(report_path)
+        report_path = '{}_{}-{}{}'.format(root, shard[0], shard[1], ext)
+    summary = progress.write_summary(report_path, interrupted)
+    if deadline and summary['remaining']:
+        logger.warning("Time budget of %ss reached, %s records not built",
+                       max_duration, summary['remaining'])
+    if summary['failed']:
+        logger.error("%s recommendations failed, %s of them could not be "
+                     "written", summary['failed'], summary['unwritten'])
+    logger.info("Time {} for {} recommendations".format(summary['duration'],
+                                                        summary['done']))
+    return summary
 
 
-def _create_recommendations(worker, record_list, reco_version):
+def _ignore_interrupts():
+    """Leave the interrupts to the parent process of the pool workers."""
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _create_recommendations(worker, record_list, reco_version, progress,
+                            build_config=None, deadline=None):
     print("Worker {} started".format(worker))
-    redis = _store.get_recommendation_store()
-    number_records = 0
-    # TODO: Return calculation time.
-    while True:
-        try:
-            recid = record_list.pop()
-        except IndexError:
-            print("End {}".format(worker))
-            return number_records
-        print("Worker {} building record: {}".format(worker, recid))
-        try:
-            nodes, weights = _reco.recommend_for_record(recid)
-            recommendations = {'records': nodes,
-                               'version': reco_version}
-            redis.set(recid, recommendations)
-        except:
-            logger.exception("Exception in Worker when calculating %s", recid,
-                             exc_info=True)
-        number_records += 1
+    build_config = build_config or {}
+    # The records are done once they are written.
+    counter = progress.worker(worker)
+    writer = BackgroundWriter(
+        _store.get_recommendation_store(),
+        batch_size=build_config.get('write_batch_size', 100),
+        queue_size=build_config.get('write_queue_size', 1000),
+        retries=build_config.get('write_retries', 5),
+        on_written=counter.add_written,
+        on_failed=counter.add_unwritten)
+    try:
+        while True:
+            if deadline and time.time() >= deadline:
+                logger.info("Worker %s reached the time budget", worker)
+                break
+            try:
+                recid = record_list.pop()
+            except IndexError:
+                print("End {}".format(worker))
+                break
+            logger.debug("Worker {} building record: {}".format(worker,
+                                                                recid))
+            start = time.time()
+            failed = False
+            try:
+                nodes, weights = _reco.recommend_for_record(recid)
+                recommendations = {'records': nodes,
+                                   'version': reco_version}
+                writer.put(recid, recommendations)
+            except Exception:
+                failed = True
+                logger.exception("Exception in Worker when calculating %s",
+                                 recid, exc_info=True)
+            counter.add(recid, time.time() - start, failed)
+    finally:
+        writer.close()
+        if writer.failed:
+            logger.error("Worker %s could not write %s recommendations",
+                         worker, writer.failed)
+    return counter.done
@@ -26,14 +26,16 @@
 
 from __future__ import absolute_import, print_function
 
+import json
+
 import click
-from IPython import embed
 
 from .app import RecordRecommender, get_config, setup_logging
-from .profiles import Profiles
-from .recommender import GraphRecommender
 from .storage import FileStore
-from .utils import get_last_weeks
+from .utils import get_last_weeks, parse_shard
+
+# The heavy dependencies (IPython, networkx, pandas, Elasticsearch) are
+# imported in the commands using them, to start the commands fast.
 
 config = None
 store = None
@@ -59,6 +61,10 @@ def cli(config_path, verbose):
 @cli.command()
 def debug():
     """Debug the application and recommender."""
+    from IPython import embed
+
+    from .recommender import GraphRecommender
+
     reco = GraphRecommender(store)
     print('# Load the user profiles into the graph.')
     print("graph = reco.load_profile('Profiles')")
@@ -72,12 +78,65 @@ def debug():
 @click.argument('weeks', type=int)
 @click.option('--force', '-f', is_flag=True,
               help='Force file overwriting.')
-def fetch(weeks, force):
+@click.option('--concurrency', type=int,
+              help='Number of streams fetched in parallel.')
+@click.option('--incremental', '-i', is_flag=True,
+              help='Only append new events to complete files.')
+def fetch(weeks, force, concurrency, incremental):
     """Fetch newest PageViews and Downloads."""
     weeks = get_last_weeks(weeks)
     print(weeks)
     recommender = RecordRecommender(config)
-    recommender.fetch_weeks(weeks, overwrite=force)
+    recommender.fetch_weeks(weeks, overwrite=force, concurrency=concurrency,
+                            incremental=incremental)
+
+
+@cli.command('import')
+@click.argument('files', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--processes', '-p', type=int, default=1,
+              help='Number of files imported in parallel.')
+@click.option('--append', '-a', is_flag=True,
+              help='Append to the week files instead of replacing them.')
+@click.option('--complete', is_flag=True,
+              help='The files hold all events of their weeks, mark the '
+                   'weeks complete so they are not fetched again.')
+def import_events(files, processes, append, complete):
+    """Import PageViews and Downloads from NDJSON files."""
+    recommender = RecordRecommender(config)
+    for prefix, year, week in recommender.import_events(files, processes,
+                                                        append, complete):
+        print("{}-{} {}".format(year, week, prefix))
+
+
+@cli.command()
+@click.argument('weeks', type=int)
+@click.option('--checksum', is_flag=True,
+              help='Compare the checksums instead of only the sizes.')
+@click.option('--write-manifest', is_flag=True,
+              help='Build the manifests of files written without one.')
+def check(weeks, checksum, write_manifest):
+    """Check the cached weeks against their manifests."""
+    for year, week in get_last_weeks(weeks):
+        for prefix in (FileStore.pageviews, FileStore.downloads,
+                       FileStore.pageviews_ip, FileStore.downloads_ip):
+            file = store.get(prefix, year, week)
+            manifest = file.get_manifest()
+            if not file.does_file_exist():
+                status = 'missing'
+            elif manifest.data is None and write_manifest:
+                manifest = file.build_manifest()
+                status = 'manifest written, {} rows'.format(
+                    manifest.data['rows'])
+            elif manifest.data is None:
+                status = 'no manifest'
+            elif not manifest.is_valid(checksum):
+                status = 'corrupt'
+            elif not manifest.data['complete']:
+                status = 'incomplete'
+            else:
+                status = 'ok, {} rows'.format(manifest.data['rows'])
+            print("{}-{} {}: {}".format(year, week, prefix, status))
 
 
 @cli.command()
@@ -94,9 +153,9 @@ def update_recommender(ctx, weeks, processes):
     """
     weeks = get_last_weeks(weeks)
     recommender = RecordRecommender(config)
-    # Redownload incomplete weeks
+    # Fetch the new events of the current weeks
     first_weeks = weeks[:2]
-    recommender.fetch_weeks(first_weeks, overwrite=True)
+    recommender.fetch_weeks(first_weeks, incremental=True)
     # Download missing weeks
     recommender.fetch_weeks(weeks, overwrite=False)
 
@@ -115,19 +174,120 @@ def profiles(weeks):
 
     Starting with the current week.
     """
-    profiles = Profiles(store)
     weeks = get_last_weeks(weeks) if isinstance(weeks, int) else weeks
     print(weeks)
-    profiles.create(weeks)
+    _get_profiles().create(weeks)
+
+
+def _get_profiles():
+    """Get the Profiles of the configured engine."""
+    profiles_config = config.get('profiles') or {}
+    if profiles_config.get('engine') == 'columnar':
+        from .columnar import ColumnarProfiles
+        return ColumnarProfiles(store, profiles_config)
+    from .profiles import Profiles
+    return Profiles(store, profiles_config)
+
+
+@cli.command()
+@click.option('--sample', '-n', type=int, default=100,
+              help='Number of random records to recommend.')
+@click.option('--record', '-r', type=int, multiple=True,
+              help='Record to recommend instead of a sample, repeatable.')
+@click.option('--seed', type=int, help='Seed of the random sample.')
+@click.option('--weeks', '-w', type=int,
+              help='Profile the creation of the Profiles of these weeks '
+                   'instead.')
+@click.option('--output', '-o', type=click.Path(file_okay=False),
+              default='profile_report', show_default=True,
+              help='Directory of the report.')
+@click.option('--no-memory', is_flag=True,
+              help='Do not trace the memory allocations, which is slow.')
+def profile(sample, record, seed, weeks, output, no_memory):
+    """
+    Profile a build on a sample of records.
+
+    Loads the graph and recommends the records, or creates the Profiles,
+    and writes the call statistics, the memory peaks and the wall time of
+    each stage into the report directory.
+    """
+    from .diagnostics import StageProfiler, profile_profiles, \
+        profile_recommendations
+
+    profiler = StageProfiler(output, memory=not no_memory)
+    if weeks:
+        profile_profiles(profiler, _get_profiles(), get_last_weeks(weeks))
+    else:
+        profile_recommendations(profiler, store, records=list(record),
+                                sample=sample, seed=seed)
+    for stage in profiler.metrics.items['stages']:
+        print("{name}: {seconds:.2f}s".format(**stage))
+    print("Report written to {}".format(profiler.write()))
+
+
+def _parse_shard(ctx, param, value):
+    """Click callback to parse the shard option."""
+    if value is None:
+        return None
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
 
 
 @cli.command()
 @click.argument('processes', type=int)
-def build(processes):
+@click.option('--shard', callback=_parse_shard, metavar='INDEX/TOTAL',
+              help='Build only one shard of the records, e.g. 0/4.')
+@click.option('--max-duration', type=int,
+              help='Stop starting new records after this many seconds.')
+def build(processes, shard, max_duration):
     """
     Calculate all recommendations using the number of specified processes.
 
     The recommendations are calculated from the generated Profiles file.
+    With ``--shard`` multiple machines can build the recommendations from
+    the same Profiles file, each one a different shard.
+    The most viewed records are built first, so with ``--max-duration`` a
+    time-boxed build refreshes the records seen most.
     """
     recommender = RecordRecommender(config)
-    recommender.create_all_recommendations(processes, ip_views=True)
+    summary = recommender.create_all_recommendations(
+        processes, ip_views=True, shard=shard, max_duration=max_duration)
+    if summary['failed']:
+        raise click.ClickException("{} of {} recommendations failed".format(
+            summary['failed'], summary['total']))
+
+
+@cli.command()
+@click.argument('source', type=click.Choice(['redis', 'sqlite']))
+@click.argument('target', type=click.Choice(['redis', 'sqlite']))
+def copy_store(source, target):
+    """Copy all recommendations in bulk from one store to another."""
+    if source == target:
+        raise click.BadParameter('Source and target store are the same.')
+    number = store.get_recommendation_store(source).copy_to(
+        store.get_recommendation_store(target))
+    print("Copied {} recommendations from {} to {}".format(number, source,
+                                                           target))
+
+
+@cli.command()
+@click.option('--shards', type=int, default=1,
+              help='Number of shards used for the build.')
+@click.option('--output', '-o', type=click.Path(),
+              help='Write the missing and outdated records as JSON.')
+def verify(shards, output):
+    """Verify that all records of the Profiles have recommendations."""
+    recommender = RecordRecommender(config)
+    report = recommender.verify_recommendations(ip_views=True, shards=shards)
+    print("Records: {}".format(report['records']))
+    print("Missing: {}".format(len(report['missing'])))
+    print("Outdated: {}".format(len(report['outdated'])))
+    for index, shard in sorted(report['shards'].items()):
+        if shard['missing'] or shard['outdated']:
+            print("Shard {}/{}: {} missing, {} outdated".format(
+                index, shards, shard['missing'], shard['outdated']))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
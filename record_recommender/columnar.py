@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Vectorized creation of the user profiles with NumPy and pandas."""
+
+from __future__ import absolute_import, print_function
+
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from .profiles import Profiles
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnarProfiles(Profiles):
+    """Create the user profiles on integer columns instead of dictionaries.
+
+    The events are loaded as NumPy columns and grouped by (user, record),
+    the profiles are DataFrames with the columns ``user``, ``recid`` and
+    ``count``. The exported Profiles are the same as with :class:`Profiles`,
+    only the ip user ids are hashed with pandas instead of md5.
+    """
+
+    def create_profiles(self, prefix, weeks, ip_user=False):
+        """
+        Create the user profiles for the given weeks.
+
+        Returns: DataFrame with the views per user and valid record.
+        """
+        with self.metrics.timer('create.{}'.format(prefix)):
+            return self._create_profiles(prefix, weeks, ip_user)
+
+    def _create_profiles(self, prefix, weeks, ip_user=False):
+        users = []
+        recids = []
+        for year, week in weeks:
+            file = self.storage.get(prefix, year, week)
+            if not file.does_file_exist():
+                logger.info("No events for %s %s-%s", prefix, year, week)
+                self.metrics.count('weeks_missing')
+                continue
+            start = time.time()
+            user, recid = self._read_week_columns(file, ip_user, year, week)
+            seconds = time.time() - start
+            users.append(user)
+            recids.append(recid)
+            self.metrics.count('events', len(recid))
+            self.metrics.count('events.{}'.format(prefix), len(recid))
+            self.metrics.add_item('weeks', prefix=prefix, year=year,
+                                  week=week, events=len(recid), cached=False,
+                                  seconds=seconds,
+                                  events_per_second=len(recid) / seconds
+                                  if seconds > 0 else None)
+
+        user = np.concatenate(users) if users else np.empty(0, np.int64)
+        recid = np.concatenate(recids) if recids else np.empty(0, np.int64)
+        self.stat['user_record_events'] = len(recid)
+
+        # Filter records with to less/much views.
+        records, counts = np.unique(recid, return_counts=True)
+        valid = records[(counts >= 2) & (counts < 100000000)]
+        self.stat['records_all'] = len(records)
+        self.stat['records_filtered'] = len(valid)
+        logger.info("Records read %s: %s", prefix, self.stat)
+        self.metrics.count('records_all.{}'.format(prefix), len(records))
+        self.metrics.count('records_valid.{}'.format(prefix), len(valid))
+
+        mask = np.isin(recid, valid)
+        events = pd.DataFrame({'user': user[mask], 'recid': recid[mask]})
+        return events.groupby(['user', 'recid'], sort=False).size() \
+            .reset_index(name='count')
+
+    def _read_week_columns(self, file, ip_user=False, year=None, week=None):
+        """Read the user and record columns of a week as integer arrays."""
+        columns = ['user', 'recid']
+        if ip_user:
+            columns += ['ip', 'user_agent']
+        data = pd.DataFrame(file.get_columns(columns))
+        data['user'] = data['user'].astype(np.int64)
+        data['recid'] = data['recid'].astype(np.int64)
+        if ip_user:
+            # Hash year, week, ip and user agent into one integer user id.
+            keys = "{0}-{1}_".format(year, week) + data['ip'] + '_' + \
+                data['user_agent']
+            user = pd.util.hash_array(keys.values.astype(object)).view(
+                np.int64)
+        else:
+            user = data['user'].values
+        return user, data['recid'].values
+
+    def _export_profiles(self, profile_name, user_pageviews, user_downloads,
+                         ip_user=False):
+        """Filter and export the user profiles."""
+        views_min = self.config.get('user_views_min')
+        views_max = self.config.get('user_views_max')
+
+        # Only users with unique pageviews.
+        unique_views = user_pageviews.groupby('user')['recid'] \
+            .transform('size').values
+        keep = (unique_views >= views_min) & (unique_views < views_max)
+        too_many = user_pageviews['user'].values[unique_views >= views_max]
+        too_few = user_pageviews['user'].values[unique_views < views_min]
+        views = user_pageviews[keep]
+
+        downloaded = pd.MultiIndex.from_arrays(
+            [views['user'].values, views['recid'].values]).isin(
+            pd.MultiIndex.from_arrays([user_downloads['user'].values,
+                                       user_downloads['recid'].values]))
+        weights = calculate_record_weights(views['count'].values, downloaded)
+
+        if ip_user:
+            users = pd.factorize(views['user'].values)[0] + 500000000000
+        else:
+            users = views['user'].values + 100000000000
+
+        with self.storage.get_user_profiles(profile_name) as store:
+            store.clear()
+            store.add_columns(users, views['recid'].values, weights)
+
+        # The rows of a user are not always adjacent, count them by user.
+        sizes = np.unique(users, return_counts=True)[1]
+        profile_sizes = self.metrics.histogram(
+            'profile_size.{}'.format(profile_name))
+        for size, number in zip(*np.unique(sizes, return_counts=True)):
+            profile_sizes.add(size, int(number))
+        self.metrics.count('users_kept.{}'.format(profile_name), len(sizes))
+        self.metrics.count('users_dropped_too_many_views.{}'.format(
+            profile_name), len(np.unique(too_many)))
+        self.metrics.count('users_dropped_too_few_views.{}'.format(
+            profile_name), len(np.unique(too_few)))
+        self.stat['user_profiles'] = len(sizes)
+        self.stat['user_profiles_records'] = len(users)
+
+        logger.info("Stats %s: %s", profile_name, self.stat)
+
+
+def calculate_record_weights(counts, downloaded, basic_weight=0.3,
+                             max_views=20, basic_weight_download=0.5):
+    """
+    Calculate the weights of the user records.
+
+    The vectorized version of
+    :meth:`Profiles._calculate_user_record_weights`.
+
+    param counts: Array with the number of views of each user record.
+    param downloaded: Boolean array, True if the record was downloaded.
+    returns: Array with the weights.
+    """
+    weights = np.where(downloaded, basic_weight_download, basic_weight)
+    counts = np.minimum(counts, max_views)
+    weight_views = float(1 / float(75)) * counts.astype(float) + \
+        1 / float(30)
+    return weights + np.where(counts > 1, weight_views, 0.0)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Profile the time and memory of builds on real data."""
+
+from __future__ import absolute_import, print_function
+
+import cProfile
+import logging
+import os
+import pstats
+import random
+import time
+from contextlib import contextmanager
+
+from .metrics import Metrics
+from .recommender import GraphRecommender
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+logger = logging.getLogger(__name__)
+
+
+class StageProfiler(object):
+    """Profile stages with cProfile, tracemalloc and their wall time.
+
+    Every stage writes its call statistics as ``<stage>.prof`` (for pstats
+    or snakeviz) and ``<stage>.txt`` into the report directory. The wall
+    times, memory peaks and the largest allocations are collected in the
+    metrics written to ``report.json``.
+    """
+
+    def __init__(self, path, memory=True, top=30):
+        """Constructor."""
+        self.path = path
+        self.memory = memory and tracemalloc is not None
+        self.top = top
+        self.metrics = Metrics()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @contextmanager
+    def stage(self, name):
+        """Profile a stage."""
+        if self.memory:
+            tracemalloc.start()
+        profiler = cProfile.Profile()
+        start = time.time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            seconds = time.time() - start
+            stage = {'name': name, 'seconds': seconds}
+            if self.memory:
+                snapshot = tracemalloc.take_snapshot()
+                stage['memory_peak'] = tracemalloc.get_traced_memory()[1]
+                stage['top_allocations'] = [
+                    {'line': str(stat.traceback), 'size': stat.size,
+                     'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:self.top]]
+                tracemalloc.stop()
+            self.metrics.add_time(name, seconds)
+            self.metrics.add_item('stages', **stage)
+            self._write_stats(name, profiler)
+            logger.info("Stage %s: %.2fs, memory peak %s", name, seconds,
+                        stage.get('memory_peak'))
+
+    def _write_stats(self, name, profiler):
+        """Write the call statistics of a stage."""
+        profiler.dump_stats(os.path.join(self.path, '{}.prof'.format(name)))
+        with open(os.path.join(self.path, '{}.txt'.format(name)), 'w') as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats('cumulative').print_stats(self.top)
+
+    def write(self):
+        """Write the report of all stages."""
+        path = os.path.join(self.path, 'report.json')
+        self.metrics.write(path)
+        return path
+
+
+def profile_recommendations(profiler, storage, records=None, sample=100,
+                            ip_views=True, seed=None):
+    """
+    Profile loading the graph and recommending a sample of records.
+
+    :param profiler: The StageProfiler.
+    :param storage: The FileStore with the Profiles.
+    :param records: The records to recommend, a random sample of ``sample``
+        records of the graph if empty.
+    :param ip_views: Load the profiles of the anonymous users too.
+    :param seed: Seed of the random sample.
+    """
+    with profiler.stage('load_graph'):
+        reco = GraphRecommender(storage)
+        reco.load_profile('Profiles')
+        if ip_views:
+            reco.load_profile('Profiles_IP')
+
+    if not records:
+        all_records = sorted(reco.all_records)
+        records = random.Random(seed).sample(
+            all_records, min(sample, len(all_records)))
+    durations = profiler.metrics.histogram('recommend_ms')
+    with profiler.stage('recommend'):
+        for recid in records:
+            start = time.time()
+            try:
+                nodes, _ = reco.recommend_for_record(recid)
+            except Exception:
+                logger.exception("Recommendation of %s failed", recid)
+                profiler.metrics.count('failed')
+                continue
+            duration = time.time() - start
+            durations.add(duration * 1000)
+            profiler.metrics.add_item('records', recid=recid,
+                                      seconds=duration,
+                                      degree=len(reco._graph[recid]),
+                                      recommendations=len(nodes))
+    profiler.metrics.count('records', len(records))
+
+
+def profile_profiles(profiler, profiles, weeks):
+    """
+    Profile the creation of the Profiles.
+
+    :param profiler: The StageProfiler.
+    :param profiles: The Profiles or ColumnarProfiles.
+    :param weeks: The (year, week) tuples.
+    """
+    with profiler.stage('profiles'):
+        profiles.create(weeks)
+    profiler.metrics.merge(profiles.metrics)
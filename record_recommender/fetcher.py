@@ -26,13 +26,18 @@
 
 from __future__ import absolute_import, print_function
 
+import json
 import logging
 import re
+import threading
 import time
+from collections import Counter
+from multiprocessing.pool import ThreadPool
 
 import urllib3
 from elasticsearch import exceptions as esd_exceptions
 from elasticsearch import Elasticsearch
+from six.moves import queue
 
 from .utils import get_week_dates
 
@@ -65,6 +70,13 @@ class ElasticsearchFetcher(object):
     }
     }"""
 
+    # Fields of the events used by the fetcher.
+    SOURCE_FIELDS = ['@timestamp', 'id_user', 'id_bibrec', 'client_host',
+                     'user_agent', 'file_format']
+
+    PAGE_SIZE_MIN = 100
+    PAGE_SIZE_MAX = 10000
+
     def __init__(self, storage, config=None):
         """Constructor."""
         self.storage = storage
@@ -72,11 +84,36 @@ class ElasticsearchFetcher(object):
                        # 'query_size': 2000,
                        # 'query_scroll_size': '10m',
                        'overwrite_files': False,
+                       'incremental': False,
+                       # Seconds before the watermark fetched again to
+                       # catch late arriving events.
+                       'incremental_overlap': 3600,
+                       # Fetch all four streams of a week with one scroll.
+                       'combined_fetch': False,
+                       # Sort the hits by time to resume failed fetches.
+                       'resumable_fetch': True,
+                       'resume_retries': 5,
+                       'resume_wait': 1.0,
+                       # Only fetch the used fields, ask for compressed
+                       # responses and adapt the page size.
+                       'lean_fetch': False,
+                       'page_size': 2000,
+                       'page_target_time': 2.0,
+                       'page_max_bytes': 10 * 1024 * 1024,
                        'es_host': '127.0.0.1',
                        'es_port': '443'
                        }
         if config:
             self.config.update(config.get('elasticsearch'))
+        self._page_size = int(self.config['page_size'])
+        es_args = {}
+        if self.config['lean_fetch']:
+            connection_class = _get_counting_connection()
+            if connection_class is None:
+                logger.warning("Compression and transfer statistics are not "
+                               "supported by this Elasticsearch client.")
+            else:
+                es_args['connection_class'] = connection_class
         self._esd = Elasticsearch(
             hosts=[
                 {
@@ -84,23 +121,236 @@ class ElasticsearchFetcher(object):
                     'port': self.config['es_port']
                 },
                 ],
-            timeout=900
+            timeout=900,
+            **es_args
         )
         # Check connection to Elasticsearch.
         self._esd.ping()
-        self._download_filter = []
+        self.event_filter = EventFilter((config or {}).get('event_filter'))
+
+    def fetch(self, year, week, overwrite=False, incremental=False):
+        """
+        Fetch PageViews and Downloads from Elasticsearch.
 
-    def fetch(self, year, week, overwrite=False):
-        """Fetch PageViews and Downloads from Elasticsearch."""
+        :param incremental: Only fetch the events newer than the ones in
+            complete week files and append them.
+        """
         self.config['overwrite_files'] = overwrite
+        self.config['incremental'] = incremental
+        transfer_stats.reset()
         time_start = time.time()
-        self._fetch_pageviews(self.storage, year, week, ip_users=False)
-        self._fetch_downloads(self.storage, year, week, ip_users=False)
-        # CDS has no user_agent before this date 1433400000:
-        self._fetch_pageviews(self.storage, year, week, ip_users=True)
-        self._fetch_downloads(self.storage, year, week, ip_users=True)
+        if self.config['combined_fetch']:
+            self._fetch_combined(year, week)
+        else:
+            self._fetch_pageviews(self.storage, year, week, ip_users=False)
+            self._fetch_downloads(self.storage, year, week, ip_users=False)
+            # CDS has no user_agent before this date 1433400000:
+            self._fetch_pageviews(self.storage, year, week, ip_users=True)
+            self._fetch_downloads(self.storage, year, week, ip_users=True)
         logger.info('Fetch %s-%s in %s seconds.', year, week,
                     time.time() - time_start)
+        if self.config['lean_fetch']:
+            self._log_transfer(year, week)
+        self.event_filter.log()
+
+    def fetch_many(self, weeks, overwrite=False, concurrency=4,
+                   incremental=False):
+        """
+        Fetch the PageViews and Downloads of many weeks in parallel.
+
+        Every (week, stream) pair is a job writing its own file, a failing
+        job does not stop the others. With ``combined_fetch`` every week is
+        one job writing the files of all streams.
+
+        Returns: List with the (year, week, prefix) of the failed jobs.
+        """
+        self.config['overwrite_files'] = overwrite
+        self.config['incremental'] = incremental
+        transfer_stats.reset()
+        streams = self._get_streams()
+        if self.config['combined_fetch']:
+            jobs = [(year, week, None) for year, week in weeks]
+        else:
+            jobs = [(year, week, prefix) for year, week in weeks
+                    for prefix in streams]
+        time_start = time.time()
+        pool = ThreadPool(max(1, min(concurrency, len(jobs))))
+        try:
+            results = pool.map(self._fetch_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        failed = [(year, week, prefix)
+                  for (year, week, job_prefix), ok in zip(jobs, results)
+                  if not ok
+                  for prefix in ([job_prefix] if job_prefix else streams)]
+        logger.info('Fetch %s jobs in %s seconds, %s failed.', len(jobs),
+                    time.time() - time_start, len(failed))
+        if self.config['lean_fetch']:
+            for year, week in weeks:
+                self._log_transfer(year, week)
+        self.event_filter.log()
+        return failed
+
+    def _log_transfer(self, year, week):
+        """Log the bytes received for a week."""
+        stats = transfer_stats.get(year, week)
+        logger.info('Fetch %s-%s: %s bytes received (%s decoded) in %s '
+                    'requests.', year, week, stats['received'],
+                    stats['decoded'], stats['requests'])
+
+    def _fetch_job(self, job):
+        """Fetch one stream of a week, return False on failure."""
+        year, week, prefix = job
+        try:
+            self.fetch_stream(prefix, year, week)
+        except Exception:
+            logger.exception('Fetch of %s %s-%s failed', prefix, year, week)
+            return False
+        return True
+
+    def _get_streams(self):
+        """Get the prefixes of the four streams."""
+        return [self.storage.pageviews, self.storage.downloads,
+                self.storage.pageviews_ip, self.storage.downloads_ip]
+
+    def fetch_stream(self, prefix, year, week):
+        """
+        Fetch one stream, e.g. ``Pageviews_IP``, of a week.
+
+        Without prefix all streams are fetched with one scroll.
+        """
+        if prefix is None:
+            return self._fetch_combined(year, week)
+        ip_users = prefix.endswith('_IP')
+        if prefix.startswith(self.storage.downloads):
+            self._fetch_downloads(self.storage, year, week, ip_users)
+        else:
+            self._fetch_pageviews(self.storage, year, week, ip_users)
+
+    def _is_cached(self, store):
+        """Check if a week file exists and was fetched completely."""
+        if not store.does_file_exist():
+            return False
+        manifest = store.get_manifest()
+        if not manifest.is_complete():
+            logger.warning("Refetch incomplete or changed file %s",
+                           store.path)
+            return False
+        return True
+
+    def _get_append_timestamp(self, store):
+        """
+        Get the timestamp after which events are appended to a file.
+
+        In incremental mode this is the newest event of a complete file
+        minus the overlap. The fetch of an incomplete file with a checkpoint
+        is continued from the checkpoint, unless files are overwritten.
+
+        Returns: The timestamp or None if the file is fetched again.
+        """
+        if not store.does_file_exist():
+            return None
+        manifest = store.get_manifest()
+        if not manifest.is_valid():
+            return None
+        data = manifest.data
+        if data['complete']:
+            if self.config['incremental'] and \
+                    data['max_timestamp'] is not None:
+                return data['max_timestamp'] - \
+                    self.config['incremental_overlap']
+        elif data.get('checkpoint') and not self.config['overwrite_files']:
+            # The events at the checkpoint are fetched again and skipped.
+            return data['checkpoint']['timestamp'] - 1
+        return None
+
+    def _open_store(self, prefix, year, week):
+        """
+        Open the file of a stream for writing.
+
+        Files written before manifests existed get a manifest built from
+        their hits and are trusted to be complete. In incremental mode a
+        complete file is opened for appending, the events are fetched from
+        its newest event minus the overlap. Files without such an event are
+        fetched again. An interrupted fetch is continued from its
+        checkpoint.
+
+        Returns: Tuple with the file, the timestamp to fetch from and a
+        Counter with the stored events after it, or None if the file is
+        cached.
+        """
+        store = self.storage.get(prefix, year, week)
+        time_from, _ = get_week_dates(year, week, as_timestamp=True)
+        transfer_stats.set_week((year, week))
+        stored = Counter()
+        if not self.config['overwrite_files'] and store.does_file_exist() \
+                and store.get_manifest().data is None:
+            logger.info("Build the manifest of %s", store.path)
+            store.build_manifest()
+        append_from = self._get_append_timestamp(store)
+        if append_from is not None:
+            time_from = max(time_from, append_from)
+            stored = _get_stored_events(store, time_from)
+            logger.info("Append to %s after %s", store.path, time_from)
+            store.open('write')
+        elif not self.config['overwrite_files'] and \
+                not self.config['incremental'] and self._is_cached(store):
+            logger.debug("File already exist, skip: {}-{}".format(year, week))
+            return None
+        else:
+            store.open('overwrite')
+        return store, time_from, stored
+
+    def _fetch_combined(self, year, week):
+        """
+        Fetch the PageViews and Downloads of a week with one scroll.
+
+        The hits are routed into the files of the four streams, cached
+        files are left as they are.
+        """
+        stores = {}
+        for prefix in self._get_streams():
+            opened = self._open_store(prefix, year, week)
+            if opened is not None:
+                stores[prefix] = opened
+        if not stores:
+            return
+
+        time_from = min(time_from for _, time_from, _ in stores.values())
+        _, time_to = get_week_dates(year, week, as_timestamp=True)
+        es_type = "(events.pageviews OR events.downloads)"
+        es_query = self.ES_QUERY % {'timestamp_start': time_from * 1000,
+                                    'timestamp_end': time_to * 1000,
+                                    'event_name': es_type,
+                                    'query_add': "AND !(bot:True)"}
+
+        logger.info("{}: {} - {}".format(es_type, time_from, time_to))
+        result = {}
+        try:
+            for hit in self._fetch_elasticsearch(es_query, result):
+                downloads = hit['_type'] == 'events.downloads'
+                ip_users = hit['_source'].get('id_user') == 0
+                prefix = self.storage.downloads if downloads \
+                    else self.storage.pageviews
+                if ip_users:
+                    prefix += '_IP'
+                if prefix not in stores:
+                    continue
+                item = get_event(hit, self.event_filter, ip_users=ip_users,
+                                 downloads=downloads)
+                if item is None:
+                    continue
+                store, store_from, stored = stores[prefix]
+                if item['timestamp'] <= store_from:
+                    # Older than the incremental fetch of this stream.
+                    continue
+                if stored and _pop_stored_event(stored, item):
+                    continue
+                store.add_hit(item)
+        finally:
+            for store, _, _ in stores.values():
+                _close_store(store, result)
 
     def _fetch_pageviews(self, storage, year, week, ip_users=False):
         """
@@ -115,14 +365,12 @@ class ElasticsearchFetcher(object):
             prefix += '_IP'
         else:
             query_add = "AND !(bot:True) AND !(id_user:0)"
-        store = self.storage.get(prefix, year, week)
-        if not self.config['overwrite_files'] and store.does_file_exist():
-            logger.debug("File already exist, skip: {}-{}".format(year, week))
+        opened = self._open_store(prefix, year, week)
+        if opened is None:
             return
+        store, time_from, stored = opened
 
-        store.open('overwrite')
-
-        time_from, time_to = get_week_dates(year, week, as_timestamp=True)
+        _, time_to = get_week_dates(year, week, as_timestamp=True)
         es_type = "events.pageviews"
         es_query = self.ES_QUERY % {'timestamp_start': time_from * 1000,
                                     'timestamp_end': time_to * 1000,
@@ -130,39 +378,20 @@ class ElasticsearchFetcher(object):
                                     'query_add': query_add}
 
         logger.info("{}: {} - {}".format(es_type, time_from, time_to))
-        for hit in self._fetch_elasticsearch(es_query):
-            item = {}
-            try:
-                item['user'] = hit['_source'].get('id_user')
-                if ip_users:
-                    assert 0 == item['user']
-                else:
-                    assert 0 != item['user']
+        result = {}
+        try:
+            for hit in self._fetch_elasticsearch(es_query, result):
                 assert es_type == hit['_type']
-
-                item['timestamp'] = float(hit['_source']['@timestamp']) / 1000
-
-                if ip_users:
-                    item['ip'] = str(hit['_source'].get('client_host'))
-                    user_agent = str(hit['_source'].get('user_agent'))
-                    if user_agent is None or user_agent == 'None':
-                        continue
-                    elif _is_bot(user_agent):
-                        continue
-                    item['user_agent'] = user_agent
-                item['recid'] = int(hit['_source'].get('id_bibrec'))
-
-            except UnicodeEncodeError as e:
-                # TODO: Error logging.
-                # print(e)
-                continue
-
-            # Save entry
-            store.add_hit(item)
-        store.close()
-        # Delete File if no hits were added.
-        if store.number_of_hits == 0:
-            store.delete()
+                item = get_event(hit, self.event_filter, ip_users=ip_users)
+                if item is None:
+                    continue
+                if stored and _pop_stored_event(stored, item):
+                    # Already fetched in the overlap.
+                    continue
+                # Save entry
+                store.add_hit(item)
+        finally:
+            _close_store(store, result)
 
     def _fetch_downloads(self, storage, year, week, ip_users=False):
         """
@@ -177,14 +406,12 @@ class ElasticsearchFetcher(object):
             prefix += '_IP'
         else:
             query_add = "AND !(bot:True) AND !(id_user:0)"
-        store = self.storage.get(prefix, year, week)
-        if not self.config['overwrite_files'] and store.does_file_exist():
-            logger.debug("File already exist, skip: {}-{}".format(year, week))
+        opened = self._open_store(prefix, year, week)
+        if opened is None:
             return
+        store, time_from, stored = opened
 
-        store.open('overwrite')
-
-        time_from, time_to = get_week_dates(year, week, as_timestamp=True)
+        _, time_to = get_week_dates(year, week, as_timestamp=True)
         es_type = "events.downloads"
         es_query = self.ES_QUERY % {'timestamp_start': time_from * 1000,
                                     'timestamp_end': time_to * 1000,
@@ -192,72 +419,212 @@ class ElasticsearchFetcher(object):
                                     'query_add': query_add}
 
         logger.info("{}: {} - {}".format(es_type, time_from, time_to))
-        for hit in self._fetch_elasticsearch(es_query):
-            item = {}
-            try:
-                item['user'] = hit['_source'].get('id_user')
-                if ip_users:
-                    assert 0 == item['user']
-                else:
-                    assert 0 != item['user']
-                assert 'events.downloads' == hit['_type']
+        result = {}
+        try:
+            for hit in self._fetch_elasticsearch(es_query, result):
+                assert es_type == hit['_type']
+                item = get_event(hit, self.event_filter, ip_users=ip_users,
+                                 downloads=True)
+                if item is None:
+                    continue
+                if stored and _pop_stored_event(stored, item):
+                    # Already fetched in the overlap.
+                    continue
+                # Save entry
+                store.add_hit(item)
+        finally:
+            _close_store(store, result)
 
-                item['timestamp'] = float(hit['_source']['@timestamp']) / 1000
+    def _fetch_elasticsearch(self, es_query, result=None):
+        """
+        Load data from Elasticsearch.
 
-                if ip_users:
-                    item['ip'] = str(hit['_source'].get('client_host'))
-                    item['user_agent'] = str(hit['_source'].get('user_agent'))
-                    user_agent = str(hit['_source'].get('user_agent'))
-                    if user_agent is None or user_agent == 'None':
-                        continue
-                    elif _is_bot(item['user_agent']):
-                        continue
-                    item['user_agent'] = user_agent
-
-                item['recid'] = int(hit['_source'].get('id_bibrec'))
-
-                file_format = str(hit['_source'].get('file_format'))
-                if len(file_format) >= 35:
-                    print("Error: file_format to long {}".format(file_format))
+        With ``scroll_slices`` above 1 the query is split into sliced
+        scrolls which are consumed in parallel.
+
+        :param es_query: The query as JSON string.
+        :param result: Dictionary updated with the number of hits and if
+            the fetch was complete.
+        :returns: Generator with the hits.
+        """
+        if self.config['lean_fetch']:
+            body = json.loads(es_query)
+            body['_source'] = self.SOURCE_FIELDS
+            es_query = json.dumps(body)
+        slices = int(self.config.get('scroll_slices') or 1)
+        if slices > 1:
+            return self._fetch_sliced(es_query, slices, result)
+        if self.config['resumable_fetch']:
+            return self._fetch_resumable(es_query, result)
+        return self._scroll(es_query, result, search_type="scan")
+
+    def _fetch_resumable(self, es_query, result=None):
+        """
+        Load data sorted by time from Elasticsearch, resuming after errors.
+
+        After an error the fetch is continued with a new query starting at
+        the timestamp of the last hit, the hits at this timestamp which were
+        already returned are skipped. The last error is raised after
+        ``resume_retries`` resumes. The fetch is complete if the hits match
+        the total of the first query.
+
+        :param es_query: The query as JSON string.
+        :param result: Dictionary updated with the number of hits, if the
+            fetch was complete and the checkpoint with the timestamp of the
+            last hit.
+        :returns: Generator with the hits.
+        """
+        body = json.loads(es_query)
+        body['sort'] = [{'@timestamp': 'asc'}]
+        time_range = _get_time_range(body)
+        total = None
+        hit_count = 0
+        last_timestamp = None
+        last_ids = set()
+        complete = False
+        retries = 0
+        try:
+            while True:
+                part = {}
+                try:
+                    for hit in self._scroll(json.dumps(body), part,
+                                            resumable=True):
+                        timestamp = hit['_source']['@timestamp']
+                        hit_id = (hit.get('_index'), hit.get('_id'))
+                        if timestamp != last_timestamp:
+                            last_timestamp = timestamp
+                            last_ids = set()
+                        elif hit_id in last_ids:
+                            continue
+                        last_ids.add(hit_id)
+                        hit_count += 1
+                        yield hit
+                    if total is None:
+                        total = part['total']
+                    complete = hit_count >= total
+                    break
+                except Exception:
+                    if total is None:
+                        total = part.get('total')
+                    if retries >= self.config['resume_retries']:
+                        raise
+                    retries += 1
+                    logger.warning("Resume fetch after %s hits at %s",
+                                   hit_count, last_timestamp, exc_info=True)
+                    time.sleep(self.config['resume_wait'] * retries)
+                    if last_timestamp is not None:
+                        time_range.pop('gt', None)
+                        time_range['gte'] = last_timestamp
+        finally:
+            if total is not None and hit_count < total:
+                logger.warning('Less hits as expected %s/%s', hit_count,
+                               total)
+            if result is not None:
+                result.update({
+                    'hits': hit_count, 'total': total, 'complete': complete,
+                    'checkpoint': None if last_timestamp is None else {
+                        'timestamp': float(last_timestamp) / 1000,
+                        'hits': hit_count}})
+
+    def _fetch_sliced(self, es_query, slices, result=None):
+        """
+        Load data from Elasticsearch with parallel sliced scrolls.
+
+        Every slice is scrolled in its own thread, the pages are merged
+        through a bounded queue into one stream of hits. Sliced scrolls need
+        Elasticsearch 5, which has no filtered query, so the query is sent
+        as bool query.
+
+        :param es_query: The query as JSON string.
+        :param slices: Number of slices.
+        :param result: Dictionary updated with the number of hits and if
+            all slices were fetched completely.
+        :returns: Generator with the hits.
+        """
+        pages = queue.Queue(maxsize=slices * 2)
+        stop = threading.Event()
+        results = [{} for _ in range(slices)]
+        errors = []
+        done = object()
+        week = transfer_stats.get_week()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return
+                except queue.Full:
                     continue
-                else:
-                    if _is_download(file_format):
-                        item['file_format'] = file_format
-                    else:
-                        # TODO: Find more file formats
-                        continue
-
-            except UnicodeEncodeError as e:
-                # TODO: Error logging.
-                # print(e)
-                continue
 
-            except KeyError as e:
-                # TODO: Error logging.
-                print(hit)
-                print(e)
-                continue
-            # Save entry
-            store.add_hit(item)
-        store.close()
-        # Delete File if no hits were added.
-        if store.number_of_hits == 0:
-            store.delete()
-
-    def _fetch_elasticsearch(self, es_query):
+        def consume(slice_id):
+            transfer_stats.set_week(week)
+            body = _to_bool_query(json.loads(es_query))
+            body['slice'] = {'id': slice_id, 'max': slices}
+            body['sort'] = ['_doc']
+            page = []
+            try:
+                for hit in self._scroll(json.dumps(body), results[slice_id]):
+                    page.append(hit)
+                    if len(page) >= 500:
+                        put(page)
+                        page = []
+                        if stop.is_set():
+                            return
+                put(page)
+            except Exception as e:
+                logger.exception("ES exception in slice %s", slice_id)
+                errors.append(e)
+            finally:
+                put(done)
+
+        threads = [threading.Thread(target=consume, args=(slice_id,))
+                   for slice_id in range(slices)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            finished = 0
+            while finished < slices:
+                page = pages.get()
+                if page is done:
+                    finished += 1
+                    continue
+                for hit in page:
+                    yield hit
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+        if result is not None:
+            result.update({
+                'hits': sum(r.get('hits', 0) for r in results),
+                'total': sum(r.get('total', 0) for r in results),
+                'complete': all(r.get('complete', False) for r in results)})
+
+    def _scroll(self, es_query, result=None, resumable=False,
+                **search_args):
         """
-        Load data from Elasticsearch.
+        Scroll through all hits of a query.
 
-        :param query: TODO
-        :param time_from: TODO
-        :param time_to: TODO
-        :returns: TODO
+        :param es_query: The query as JSON string.
+        :param result: Dictionary updated with the number of hits and if
+            the fetch was complete.
+        :param resumable: Raise errors instead of stopping, to resume the
+            fetch.
+        :returns: Generator with the hits.
         """
         # TODO: Show error if index is not found.
+        bytes_start = transfer_stats.thread_bytes()
+        request_start = time.time()
         scanResp = self._esd.search(index=self.config['es_index'],
-                                    body=es_query, size=2000,
-                                    search_type="scan", scroll="10000",
-                                    timeout=900, request_timeout=900)
+                                    body=es_query, size=self._page_size,
+                                    scroll="10000", timeout=900,
+                                    request_timeout=900, **search_args)
+        request_time = time.time() - request_start
+        pages = 1
         resp = dict(scanResp)
         resp.pop('_scroll_id')
         logger.debug(resp)
@@ -270,11 +637,23 @@ class ElasticsearchFetcher(object):
         retry_count = 0
         number_of_retrys = 5
         hit_count = 0
+        complete = True
+        if result is not None:
+            result.update({'hits': 0, 'total': scroll_hits,
+                           'complete': False})
+
+        # Only scan searches return no hits with the first response.
+        for hit in scanResp['hits']['hits']:
+            yield hit
+            hit_count += 1
 
         while True:
             try:
+                request_start = time.time()
                 response = self._esd.scroll(scroll_id=scrollId, scroll="10000",
                                             request_timeout=900)
+                request_time += time.time() - request_start
+                pages += 1
                 if response['_scroll_id'] != scrollId:
                     scrollId = response['_scroll_id']
                 if scanResp['_shards']['failed'] > 0:
@@ -293,11 +672,11 @@ class ElasticsearchFetcher(object):
             except StopIteration:
                 break
 
-            except Exception as e:
-                # TODO: Logging
-                logging.exception("ES exception", exc_info=True)
-                print("EXCEPTION")
-                print(e)
+            except Exception:
+                if resumable:
+                    raise
+                logger.exception("ES exception")
+                complete = False
                 break
 
             for hit in response["hits"]["hits"]:
@@ -310,52 +689,348 @@ class ElasticsearchFetcher(object):
         elif hit_count < scroll_hits:
             # Less hits as expected, something went wrong.
             logger.warn('Less hits as expected %s/%s', hit_count, scroll_hits)
+            complete = False
         logger.info('%s Hits', hit_count)
+        if self.config['lean_fetch']:
+            self._adapt_page_size(
+                pages, request_time,
+                transfer_stats.thread_bytes() - bytes_start)
+        if result is not None:
+            result.update({'hits': hit_count, 'total': scroll_hits,
+                           'complete': complete})
 
+    def _adapt_page_size(self, pages, request_time, received):
+        """
+        Adapt the page size of the next queries to the last one.
+
+        The size is halved if the pages took longer than the target time or
+        were larger than the maximum, and doubled if they were well below.
+        """
+        page_time = request_time / pages
+        page_bytes = float(received) / pages
+        target_time = self.config['page_target_time']
+        max_bytes = self.config['page_max_bytes']
+        size = self._page_size
+        if page_time > target_time or page_bytes > max_bytes:
+            size //= 2
+        elif page_time < target_time / 4 and page_bytes < max_bytes / 4:
+            size *= 2
+        size = max(self.PAGE_SIZE_MIN, min(self.PAGE_SIZE_MAX, size))
+        if size != self._page_size:
+            logger.debug('Page size %s (%.2fs, %s bytes per page)', size,
+                         page_time, page_bytes)
+        self._page_size = size
+
+
+class TransferStats(object):
+    """Requests and bytes received from Elasticsearch per week.
+
+    The requests are counted for the week fetched by the calling thread.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.weeks = {}
+
+    def reset(self):
+        """Forget the statistics of the previous fetches."""
+        with self._lock:
+            self.weeks = {}
+
+    def set_week(self, week):
+        """Set the (year, week) fetched by the current thread."""
+        self._local.week = week
+
+    def get_week(self):
+        """Get the (year, week) fetched by the current thread."""
+        return getattr(self._local, 'week', None)
+
+    def thread_bytes(self):
+        """Get the decoded bytes received by the current thread."""
+        return getattr(self._local, 'bytes', 0)
+
+    def add(self, received, decoded):
+        """Count a response of the current thread."""
+        self._local.bytes = self.thread_bytes() + decoded
+        with self._lock:
+            stats = self.weeks.setdefault(
+                self.get_week(), {'requests': 0, 'received': 0, 'decoded': 0})
+            stats['requests'] += 1
+            stats['received'] += received
+            stats['decoded'] += decoded
+
+    def get(self, year, week):
+        """Get the statistics of a week."""
+        with self._lock:
+            return dict(self.weeks.get((year, week)) or
+                        {'requests': 0, 'received': 0, 'decoded': 0})
+
+
+transfer_stats = TransferStats()
+
+_counting_connection = None
 
-def _is_bot(user_agent):
-    """Check if user_agent is a known bot."""
-    bot_list = [
-                'http://www.baidu.com/search/spider.html',
-                'python-requests',
-                'http://ltx71.com/',
-                'http://drupal.org/',
-                'www.sogou.com',
-                'http://search.msn.com/msnbot.htm',
-                'semantic-visions.com crawler',
-               ]
-    for bot in bot_list:
-        if re.search(re.escape(bot), user_agent):
-            return True
-    return False
 
+def _get_counting_connection():
+    """
+    Get a connection class asking for compressed responses and counting them.
 
-def _is_download(ending):
-    """Check if file ending is considered as download."""
-    list = [
-            'PDF',
-            'DOC',
-            'TXT',
-            'PPT',
-            'XLSX',
-            'MP3',
-            'SVG',
-            '7Z',
-            'HTML',
-            'TEX',
-            'MPP',
-            'ODT',
-            'RAR',
-            'ZIP',
-            'TAR',
-            'EPUB',
-           ]
-    list_regex = [
-                  'PDF'
-                 ]
-    if ending in list:
+    The class is created on first use as the connection classes differ
+    between the Elasticsearch clients. Returns None if the client has no
+    urllib3 connection class to extend.
+    """
+    global _counting_connection
+    if _counting_connection is not None:
+        return _counting_connection
+    try:
+        from elasticsearch import Urllib3HttpConnection
+    except ImportError:
+        return None
+
+    class CountingConnection(Urllib3HttpConnection):
+        """Urllib3 connection with compression and transfer statistics.
+
+        The received bytes are the bytes read from the socket before the
+        responses are decompressed.
+        """
+
+        def __init__(self, *args, **kwargs):
+            """Constructor."""
+            super(CountingConnection, self).__init__(*args, **kwargs)
+            compression = urllib3.make_headers(accept_encoding=True)
+            # Older clients send the headers of the pool.
+            for headers in (getattr(self, 'headers', None),
+                            getattr(self.pool, 'headers', None)):
+                if headers is not None:
+                    headers.update(compression)
+            self.pool = _CountingPool(self.pool)
+
+        def perform_request(self, *args, **kwargs):
+            """Perform the request and count the received bytes."""
+            self.pool.responses.last = None
+            status, headers, data = super(
+                CountingConnection, self).perform_request(*args, **kwargs)
+            decoded = len(data or '')
+            response = self.pool.responses.last
+            received = response.tell() if response is not None else decoded
+            transfer_stats.add(received, decoded)
+            return status, headers, data
+
+    _counting_connection = CountingConnection
+    return _counting_connection
+
+
+class _CountingPool(object):
+    """Urllib3 pool keeping the last response of each thread.
+
+    The connection of the Elasticsearch client is shared by the fetching
+    threads, everything else is passed to the wrapped pool.
+    """
+
+    def __init__(self, pool):
+        """Constructor."""
+        self._pool = pool
+        self.responses = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    def urlopen(self, *args, **kwargs):
+        """Open the url and keep its response."""
+        response = self._pool.urlopen(*args, **kwargs)
+        self.responses.last = response
+        return response
+
+
+def _close_store(store, result):
+    """
+    Close a fetched file, it is deleted if no hits were added.
+
+    The checkpoint of an incomplete fetch is kept in the manifest to
+    continue it later.
+    """
+    store.close()
+    if store.number_of_hits == 0:
+        store.delete()
+    else:
+        complete = result.get('complete', False)
+        store.write_manifest(
+            complete=complete,
+            checkpoint=None if complete else result.get('checkpoint'))
+
+
+def _to_bool_query(body):
+    """Turn the filtered query of a search into the equal bool query."""
+    filtered = body['query'].pop('filtered')
+    body['query']['bool'] = {'must': filtered['query'],
+                             'filter': filtered['filter']}
+    return body
+
+
+def _get_time_range(body):
+    """Get the ``@timestamp`` range of a filtered or bool query."""
+    query = body['query']
+    query = query['filtered'] if 'filtered' in query else query['bool']
+    return query['filter']['range']['@timestamp']
+
+
+def _event_key(timestamp, user, recid, ip):
+    """Get the key identifying an event in a week file."""
+    return (float(timestamp), int(user), int(recid), str(ip or ''))
+
+
+def _get_stored_events(store, time_from):
+    """Count the events of a week file newer than the timestamp."""
+    stored = Counter()
+    for block in store.get_blocks(['timestamp', 'user', 'recid', 'ip']):
+        newer = block['timestamp'] > time_from
+        stored.update(_event_key(*event) for event in zip(
+            *[block[name][newer].tolist()
+              for name in ('timestamp', 'user', 'recid', 'ip')]))
+    return stored
+
+
+def _pop_stored_event(stored, item):
+    """Check if an event is stored and remove it from the Counter."""
+    key = _event_key(item['timestamp'], item['user'], item['recid'],
+                     item.get('ip'))
+    if stored[key] > 0:
+        stored[key] -= 1
         return True
-    for file_type in list_regex:
-        if re.search(re.escape(file_type), ending):
-            return True
     return False
+
+
+def get_event(hit, event_filter, ip_users=False, downloads=False):
+    """
+    Get the event written to the week files from a hit.
+
+    :param hit: The hit from Elasticsearch.
+    :param event_filter: The EventFilter dropping bots and other formats.
+    :param ip_users: If the hit is from an anonymous user.
+    :param downloads: If the hit is a download.
+    :returns: Dictionary with the event or None if it is dropped.
+    """
+    source = hit['_source']
+    item = {}
+    try:
+        # Events without user can not be stored in the typed week files.
+        item['user'] = int(source['id_user'])
+        if ip_users:
+            assert 0 == item['user']
+        else:
+            assert 0 != item['user']
+
+        item['timestamp'] = float(source['@timestamp']) / 1000
+
+        if ip_users:
+            item['ip'] = str(source.get('client_host'))
+            user_agent = str(source.get('user_agent'))
+            if user_agent == 'None':
+                return event_filter.drop('no_user_agent')
+            elif event_filter.is_bot(user_agent):
+                return event_filter.drop('bot')
+            item['user_agent'] = user_agent
+
+        item['recid'] = int(source.get('id_bibrec'))
+
+        if downloads:
+            file_format = str(source.get('file_format'))
+            if len(file_format) >= 35:
+                logger.debug("file_format to long %s", file_format)
+                return event_filter.drop('long_file_format')
+            elif not event_filter.is_download(file_format):
+                # TODO: Find more file formats
+                return event_filter.drop('no_download')
+            item['file_format'] = file_format
+
+    except UnicodeEncodeError:
+        return event_filter.drop('encoding')
+
+    except (KeyError, TypeError, ValueError):
+        logger.debug("Malformed hit %s", hit)
+        return event_filter.drop('malformed')
+    return item
+
+
+class EventFilter(object):
+    """Drop the events of bots and of files not counted as downloads.
+
+    The patterns of a rule are compiled into one regular expression and the
+    results are cached, as the same user agents and file formats repeat.
+    """
+
+    BOT_PATTERNS = [
+        'http://www.baidu.com/search/spider.html',
+        'python-requests',
+        'http://ltx71.com/',
+        'http://drupal.org/',
+        'www.sogou.com',
+        'http://search.msn.com/msnbot.htm',
+        'semantic-visions.com crawler',
+    ]
+
+    DOWNLOAD_FORMATS = [
+        'PDF', 'DOC', 'TXT', 'PPT', 'XLSX', 'MP3', 'SVG', '7Z', 'HTML', 'TEX',
+        'MPP', 'ODT', 'RAR', 'ZIP', 'TAR', 'EPUB',
+    ]
+
+    # Formats containing these are downloads, e.g. ``PDF;PDFA``.
+    DOWNLOAD_PATTERNS = ['PDF']
+
+    def __init__(self, config=None):
+        """Constructor."""
+        self.config = {'bot_patterns': self.BOT_PATTERNS,
+                       'download_formats': self.DOWNLOAD_FORMATS,
+                       'download_patterns': self.DOWNLOAD_PATTERNS,
+                       'cache_size': 100000}
+        if config:
+            self.config.update(config)
+        self._bot = _compile_patterns(self.config['bot_patterns'])
+        self._download_formats = frozenset(self.config['download_formats'])
+        self._download = _compile_patterns(self.config['download_patterns'])
+        self._bot_cache = {}
+        self._download_cache = {}
+        self._lock = threading.Lock()
+        self.dropped = Counter()
+
+    def is_bot(self, user_agent):
+        """Check if the user agent is a known bot."""
+        result = self._bot_cache.get(user_agent)
+        if result is None:
+            result = bool(self._bot and self._bot.search(user_agent))
+            self._cache(self._bot_cache, user_agent, result)
+        return result
+
+    def is_download(self, file_format):
+        """Check if the file format is considered as download."""
+        result = self._download_cache.get(file_format)
+        if result is None:
+            result = file_format in self._download_formats or \
+                bool(self._download and self._download.search(file_format))
+            self._cache(self._download_cache, file_format, result)
+        return result
+
+    def _cache(self, cache, key, value):
+        """Cache a result, the cache is cleared when it is full."""
+        if len(cache) >= self.config['cache_size']:
+            cache.clear()
+        cache[key] = value
+
+    def drop(self, rule):
+        """Count an event dropped by a rule, returns None."""
+        with self._lock:
+            self.dropped[rule] += 1
+
+    def log(self):
+        """Log the number of dropped events per rule."""
+        for rule, count in sorted(self.dropped.items()):
+            logger.info("Dropped %s events: %s", rule, count)
+
+
+def _compile_patterns(patterns):
+    """Compile the literal patterns into one regular expression."""
+    if not patterns:
+        return None
+    return re.compile('|'.join(re.escape(pattern) for pattern in patterns))
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Import PageViews and Downloads from exported event dumps."""
+
+from __future__ import absolute_import, print_function
+
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import time
+from collections import Counter, OrderedDict, defaultdict
+from multiprocessing import Pool
+
+from .fetcher import EventFilter, get_event
+from .storage import FileStore
+from .utils import get_year_week
+
+logger = logging.getLogger(__name__)
+
+
+class EventImporter(object):
+    """Import hits from NDJSON files into the week files.
+
+    Every line of a file is an Elasticsearch hit with ``_type`` and
+    ``_source``, as written by the usual export tools. The files can be
+    gzip compressed. The hits are filtered like fetched ones and written to
+    the file of their week.
+    """
+
+    def __init__(self, storage, config=None):
+        """Constructor."""
+        self.storage = storage
+        self.config = config or {}
+
+    def import_files(self, paths, processes=1, append=False,
+                     complete=False):
+        """
+        Import the files, in parallel with more than one process.
+
+        Every file is imported into its own part files, which are merged
+        into the week files afterwards. The imported weeks are only marked
+        complete if the files hold all their events, otherwise they are
+        fetched again.
+
+        :param paths: The NDJSON files.
+        :param processes: Number of files imported in parallel.
+        :param append: Append to existing week files instead of replacing
+            them, a complete week file stays complete.
+        :param complete: The files hold all events of their weeks.
+        :returns: List with the imported (prefix, year, week) files.
+        """
+        time_start = time.time()
+        parts_path = "{}import-parts/".format(self.storage.base_path)
+        jobs = [(self.config, path, "{}{}/".format(parts_path, i))
+                for i, path in enumerate(paths)]
+        parts = defaultdict(list)
+        dropped = Counter()
+        try:
+            for files, part_dropped in self._import_parts(jobs, processes):
+                dropped.update(part_dropped)
+                for key, part in files:
+                    parts[key].append(part)
+            for key in sorted(parts):
+                self._merge(key, parts[key], append, complete)
+        finally:
+            shutil.rmtree(parts_path, ignore_errors=True)
+
+        for rule, count in sorted(dropped.items()):
+            logger.info("Dropped %s events: %s", rule, count)
+        logger.info('Import %s files into %s week files in %s seconds.',
+                    len(paths), len(parts), time.time() - time_start)
+        return sorted(parts)
+
+    def _import_parts(self, jobs, processes):
+        """Import every file into part files."""
+        processes = min(processes or 1, len(jobs))
+        if processes <= 1:
+            for job in jobs:
+                yield _import_file(job)
+            return
+
+        pool = Pool(processes)
+        try:
+            for result in pool.imap_unordered(_import_file, jobs):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _merge(self, key, parts, append, complete=False):
+        """Merge the part files of a week into its week file."""
+        prefix, year, week = key
+        target = self.storage.get(prefix, year, week)
+        was_complete = target.get_manifest().is_complete()
+        if append:
+            complete = complete or was_complete
+        else:
+            if was_complete and not complete:
+                logger.warning("Replace the complete week file %s with "
+                               "incomplete imported events", target.path)
+            target.delete()
+        for path in parts:
+            target.append_file(type(target)(path, prefix, year, week))
+        target.write_manifest(complete=complete)
+
+
+def _import_file(args):
+    """
+    Import one NDJSON file into part files.
+
+    At most ``max_open_files`` part files are open at once, the least
+    recently used one is closed and appended to when its week comes again.
+
+    :param args: Tuple with the config, the file and the directory of its
+        part files.
+    :returns: Tuple with the written ((prefix, year, week), path) part files
+        and the dropped events per rule.
+    """
+    config, path, parts_path = args
+    # Left behind by an interrupted import.
+    shutil.rmtree(parts_path, ignore_errors=True)
+    os.makedirs(parts_path)
+    part_config = dict(config)
+    part_config['cache'] = dict(config.get('cache') or {},
+                                base_path=parts_path)
+    max_open = max(1, (config.get('import') or {}).get('max_open_files', 64))
+    storage = FileStore(part_config)
+    event_filter = EventFilter(config.get('event_filter'))
+    writers = OrderedDict()
+    paths = {}
+    try:
+        for hit in _read_hits(path, event_filter):
+            downloads = hit['_type'] == 'events.downloads'
+            ip_users = hit['_source'].get('id_user') == 0
+            item = get_event(hit, event_filter, ip_users=ip_users,
+                             downloads=downloads)
+            if item is None:
+                continue
+            prefix = storage.downloads if downloads else storage.pageviews
+            if ip_users:
+                prefix += '_IP'
+            key = (prefix, ) + get_year_week(item['timestamp'])
+            writer = writers.pop(key, None)
+            if writer is None:
+                if len(writers) >= max_open:
+                    # The manifest keeps the statistics of the closed file.
+                    writers.popitem(last=False)[1].write_manifest(
+                        complete=False)
+                writer = storage.get(*key)
+                writer.open('write' if key in paths else 'overwrite')
+                paths[key] = writer.path
+            writers[key] = writer
+            writer.add_hit(item)
+    except Exception:
+        for writer in writers.values():
+            writer.close()
+        raise
+    for key in paths:
+        writer = writers.get(key)
+        if writer is None:
+            writer = storage.get(*key)
+            writer.open('write')
+        writer.write_manifest(complete=True)
+    logger.info('Imported %s', path)
+    return list(paths.items()), event_filter.dropped
+
+
+def _read_hits(path, event_filter):
+    """Read the hits of pageviews and downloads from a NDJSON file."""
+    if path.endswith('.gz'):
+        filep = io.TextIOWrapper(gzip.open(path, 'rb'), encoding='utf-8')
+    else:
+        filep = io.open(path, 'r', encoding='utf-8')
+    with filep:
+        for line in filep:
+            if not line.strip():
+                continue
+            try:
+                hit = json.loads(line)
+            except ValueError:
+                event_filter.drop('malformed')
+                continue
+            if hit.get('_type') not in ('events.pageviews',
+                                        'events.downloads'):
+                event_filter.drop('other_type')
+            elif hit.get('_source', {}).get('bot'):
+                # Like the !(bot:True) of the fetch queries.
+                event_filter.drop('bot')
+            else:
+                yield hit
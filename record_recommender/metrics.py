@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Timers, counters and bounded-memory histograms for the pipelines."""
+
+from __future__ import absolute_import, print_function
+
+import json
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from six import iteritems
+
+
+class Histogram(object):
+    """Streaming histogram of non-negative integers.
+
+    Values are counted in power of two buckets, so the memory stays bounded
+    no matter how many values are added.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = defaultdict(int)
+
+    def add(self, value, count=1):
+        """Add a value, ``count`` times."""
+        value = int(value)
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.buckets[max(value, 0).bit_length()] += count
+
+    def merge(self, other):
+        """Add the values of another histogram."""
+        for bucket, count in iteritems(other.buckets):
+            self.buckets[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """Get the upper bound of the bucket holding the percentile."""
+        if not self.count:
+            return None
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= threshold:
+                return min(2 ** bucket - 1, self.max)
+        return self.max
+
+    def to_dict(self):
+        """Get the histogram as dictionary."""
+        return {
+            'count': self.count,
+            'mean': self.total / float(self.count) if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': OrderedDict(
+                ('<={}'.format(2 ** bucket - 1), self.buckets[bucket])
+                for bucket in sorted(self.buckets)),
+        }
+
+
+class Metrics(object):
+    """Collect the timers, counters and histograms of a run."""
+
+    def __init__(self):
+        """Constructor."""
+        self.timers = OrderedDict()
+        self.counters = Counter()
+        self.histograms = OrderedDict()
+        self.items = OrderedDict()
+
+    @contextmanager
+    def timer(self, name):
+        """Measure the time of a phase."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        """Add seconds to a timer."""
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        """Increment a counter."""
+        self.counters[name] += value
+
+    def histogram(self, name):
+        """Get a histogram, it is created on first use."""
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def add_item(self, section, **values):
+        """Add a detail entry, e.g. the numbers of a single week."""
+        self.items.setdefault(section, []).append(values)
+
+    def merge(self, other):
+        """Merge the metrics of another run, e.g. of a worker process."""
+        for name, seconds in iteritems(other.timers):
+            self.add_time(name, seconds)
+        self.counters.update(other.counters)
+        for name, histogram in iteritems(other.histograms):
+            self.histogram(name).merge(histogram)
+        for section, items in iteritems(other.items):
+            self.items.setdefault(section, []).extend(items)
+
+    def to_dict(self):
+        """Get all metrics as dictionary."""
+        return {
+            'timers': self.timers,
+            'counters': dict(self.counters),
+            'histograms': OrderedDict(
+                (name, histogram.to_dict())
+                for name, histogram in iteritems(self.histograms)),
+            'items': self.items,
+        }
+
+    def log(self, logger):
+        """Log a summary of the metrics."""
+        for name, seconds in iteritems(self.timers):
+            logger.info("Time %s: %.2fs", name, seconds)
+        for name, value in sorted(iteritems(self.counters)):
+            logger.info("Count %s: %s", name, value)
+        for name, histogram in iteritems(self.histograms):
+            data = histogram.to_dict()
+            logger.info("Histogram %s: count %s, mean %s, p50 %s, p90 %s, "
+                        "p99 %s, max %s", name, data['count'], data['mean'],
+                        data['p50'], data['p90'], data['p99'], data['max'])
+
+    def write(self, path):
+        """Write the metrics as JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
@@ -28,10 +28,14 @@ from __future__ import absolute_import, print_function
 
 import hashlib
 import logging
-from collections import defaultdict
+import time
+from collections import Counter, defaultdict
+from multiprocessing import Pool
 
 from six import iteritems
 
+from .metrics import Metrics
+
 logger = logging.getLogger(__name__)
 
 
@@ -46,23 +50,44 @@ class Profiles(object):
                      }
         self.config = {'user_views_min': 2,
                        'user_views_max': 400,
+                       'cache_aggregates': True,
+                       'workers': 1,
                        }
         if config:
             self.config.update(config)
-        self.stat_long = defaultdict(list)
+        self.metrics = Metrics()
 
     def create(self, weeks):
         """Create the user and ip profiles for the given weeks."""
-        user_pageviews = self.create_profiles('Pageviews', weeks)
-        user_downloads = self.create_profiles('Downloads', weeks)
-
-        self._export_profiles('Profiles', user_pageviews, user_downloads)
-
-        user_pageviews = self.create_profiles('Pageviews_IP', weeks, True)
-        user_downloads = self.create_profiles('Downloads_IP', weeks, True)
-
-        self._export_profiles('Profiles_IP', user_pageviews, user_downloads,
-                              ip_user=True)
+        with self.metrics.timer('total'):
+            user_pageviews = self.create_profiles('Pageviews', weeks)
+            user_downloads = self.create_profiles('Downloads', weeks)
+
+            with self.metrics.timer('export.Profiles'):
+                self._export_profiles('Profiles', user_pageviews,
+                                      user_downloads)
+
+            user_pageviews = self.create_profiles('Pageviews_IP', weeks, True)
+            user_downloads = self.create_profiles('Downloads_IP', weeks, True)
+
+            with self.metrics.timer('export.Profiles_IP'):
+                self._export_profiles('Profiles_IP', user_pageviews,
+                                      user_downloads, ip_user=True)
+
+        self.report()
+
+    def report(self):
+        """Log the metrics of the run and write them as JSON report."""
+        events = self.metrics.counters.get('events', 0)
+        seconds = sum(item['seconds']
+                      for item in self.metrics.items.get('weeks', []))
+        if seconds > 0:
+            logger.info("Read %s events, %.0f events/s", events,
+                        events / seconds)
+        self.metrics.log(logger)
+        report_path = self.config.get('report_path') or \
+            "{}profiles_report.json".format(self.storage.base_path)
+        self.metrics.write(report_path)
 
     def _export_profiles(self, profile_name, user_pageviews, user_downloads,
                          ip_user=False):
@@ -72,6 +97,9 @@ class Profiles(object):
         ip_user_id = 500000000000
         add_user_id = 100000000000
         stat_records = 0
+        stat_users = 0
+        profile_sizes = self.metrics.histogram(
+            'profile_size.{}'.format(profile_name))
         with self.storage.get_user_profiles(profile_name) as store:
             store.clear()
             for user in user_pageviews:
@@ -87,56 +115,175 @@ class Profiles(object):
                     else:
                         user = str(add_user_id + int(user))
                         store.add_user(user, nodes, weight)
-                    self.stat_long['User_num_records'].append(len(nodes))
+                    profile_sizes.add(len(nodes))
+                    stat_users += 1
                     stat_records += len(nodes)
 
                 elif unique_views >= views_min:
-                    # TODO: Add stat for to many views.
-                    print("Drop user {} with {} views".format(user,
-                                                              unique_views))
-        self.stat['user_profiles'] = len(self.stat_long.get(
-                                                        'User_num_records'))
+                    logger.debug("Drop user %s with %s views", user,
+                                 unique_views)
+                    self.metrics.count('users_dropped_too_many_views.{}'
+                                       .format(profile_name))
+                else:
+                    self.metrics.count('users_dropped_too_few_views.{}'
+                                       .format(profile_name))
+        self.metrics.count('users_kept.{}'.format(profile_name), stat_users)
+        self.stat['user_profiles'] = stat_users
         self.stat['user_profiles_records'] = stat_records
 
-        print("Stats: {}".format(self.stat))
+        logger.info("Stats %s: %s", profile_name, self.stat)
 
     def create_profiles(self, prefix, weeks, ip_user=False):
-        """Create the user profiles for the given weeks."""
+        """
+        Create the user profiles for the given weeks.
+
+        Returns: Dictionary with the user id and a counter of the viewed
+        records.
+        {'2323': Counter({'1': 2, '4': 1})}
+        """
         # Future: Add a time range in weeks for how long a user is considered
         #         as the same user.
 
-        # Count accessed records
-        record_counter = {}
-        for year, week in weeks:
-            file = self.storage.get(prefix, year, week)
-            self.count_records(record_counter, file)
+        # Count accessed records and collect tentative user profiles.
+        record_counter = Counter()
+        profiles = defaultdict(Counter)
+        with self.metrics.timer('create.{}'.format(prefix)):
+            for counts, users in self._get_week_aggregates(prefix, weeks,
+                                                           ip_user):
+                record_counter.update(counts)
+                for uid, records in iteritems(users):
+                    profiles[uid].update(records)
+
+            self.stat['user_record_events'] = sum(record_counter.values())
+
+            # Filter records with to less/much views.
+            records_valid = self.filter_counter(record_counter)
+            logger.info("Records read %s: %s", prefix, self.stat)
+            self.metrics.count('records_all.{}'.format(prefix),
+                               self.stat['records_all'])
+            self.metrics.count('records_valid.{}'.format(prefix),
+                               self.stat['records_filtered'])
+
+            return self._filter_profiles(profiles, records_valid)
+
+    def _get_week_aggregates(self, prefix, weeks, ip_user=False):
+        """
+        Get the aggregates of the weeks in the order of the weeks.
+
+        With more than one configured worker the weeks are read in a process
+        pool, the result is the same as reading them one after another.
+        """
+        workers = min(self.config.get('workers') or 1, len(weeks))
+        if workers <= 1:
+            for year, week in weeks:
+                yield self._get_week_aggregate(prefix, year, week, ip_user)
+            return
+
+        pool = Pool(workers)
+        try:
+            jobs = [(self.storage, self.config, prefix, year, week, ip_user)
+                    for year, week in weeks]
+            for aggregate, metrics in pool.imap(_get_week_aggregate, jobs):
+                self.metrics.merge(metrics)
+                yield aggregate
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _get_week_aggregate(self, prefix, year, week, ip_user=False):
+        """
+        Get the record counts and user profiles of a week.
 
-        # TODO: Statistics, count records
-        print("Records read all: {}".format(self.stat))
+        The aggregate is cached next to the week file and only recomputed
+        if the week file changed.
+        """
+        file = self.storage.get(prefix, year, week)
+        if not file.does_file_exist():
+            logger.info("No events for %s %s-%s", prefix, year, week)
+            self.metrics.count('weeks_missing')
+            return {}, {}
+
+        start = time.time()
+        cache = None
+        aggregate = None
+        if self.config.get('cache_aggregates'):
+            cache = self.storage.get_week_aggregate(prefix, year, week,
+                                                    ip_user)
+            aggregate = cache.load()
+            if aggregate is not None:
+                logger.debug("Use cached aggregate %s", cache.path)
+
+        cached = aggregate is not None
+        if not cached:
+            counts, users = self._read_week(file, ip_user, year, week)
+            if cache is not None:
+                cache.save(counts, users)
+            aggregate = dict(counts), dict(users)
+
+        seconds = time.time() - start
+        events = sum(aggregate[0].values())
+        self.metrics.count('events', events)
+        self.metrics.count('events.{}'.format(prefix), events)
+        self.metrics.add_item('weeks', prefix=prefix, year=year, week=week,
+                              events=events, users=len(aggregate[1]),
+                              cached=cached, seconds=seconds,
+                              events_per_second=events / seconds
+                              if seconds > 0 else None)
+        return aggregate
+
+    def _read_week(self, file, ip_user=False, year=None, week=None):
+        """
+        Count the viewed records and collect the user profiles of a week.
 
-        # Filter records with to less/much views.
-        records_valid = self.filter_counter(record_counter)
+        The profiles contain all records, not only the valid ones, they are
+        filtered with :meth:`_filter_profiles` once all weeks are merged.
 
-        # Create user profiles
-        profiles = defaultdict(list)
-        for year, week in weeks:
-            file = self.storage.get(prefix, year, week)
-            self._create_user_profiles(profiles, file, records_valid, ip_user,
-                                       year, week)
+        Returns: Tuple with the record counts and the user profiles.
+        """
+        record_counter = Counter()
+        profiles = defaultdict(Counter)
+        columns = ['user', 'recid']
+        if ip_user:
+            columns += ['ip', 'user_agent']
+        for block in file.get_blocks(columns):
+            recids = [str(recid) for recid in block['recid'].tolist()]
+            record_counter.update(recids)
+            if ip_user:
+                users = [self._get_ip_user_id(ip, user_agent, year, week)
+                         for ip, user_agent in zip(
+                             block['ip'].tolist(),
+                             block['user_agent'].tolist())]
+            else:
+                users = [str(user) for user in block['user'].tolist()]
+            for uid, recid in zip(users, recids):
+                profiles[uid][recid] += 1
 
-        return profiles
+        return record_counter, profiles
 
-    def count_records(self, record_counter, file):
-        """Count the number of viewed records."""
-        counter = record_counter
-        events_counter = 0
-        for record in file.get_records():
-            recid = record[2]
-            counter[recid] = counter.get(recid, 0) + 1
-            events_counter += 1
+    def _filter_profiles(self, profiles, valid_records):
+        """
+        Remove the records which are not valid from the user profiles.
 
-        self.stat['user_record_events'] = events_counter
-        return counter
+        Returns: Dictionary with the user id and a counter of the records,
+        users without valid records are dropped.
+        """
+        filtered = defaultdict(Counter)
+        for uid, records in iteritems(profiles):
+            records = Counter(dict(
+                (recid, count) for recid, count in iteritems(records)
+                if valid_records.get(recid, None)))
+            if records:
+                filtered[uid] = records
+        return filtered
+
+    def _get_ip_user_id(self, ip, user_agent, year=None, week=None):
+        """Get the user id of an event of a not logged in user."""
+        # Generate unique user id
+        user_id = "{0}-{1}_{2}_{3}".format(year, week, ip, user_agent)
+        try:
+            return hashlib.md5(user_id.encode('utf-8')).hexdigest()
+        except UnicodeDecodeError:
+            logger.info("UnicodeDecodeError {}".format(user_id))
 
     def filter_counter(self, counter, min=2, max=100000000):
         """
@@ -151,40 +298,10 @@ class Profiles(object):
             if max > counter[item] >= min:
                 records_filterd[item] = counter[item]
 
-        self.stat['user_record_events'] = counter_all_records
+        self.stat['records_all'] = counter_all_records
         self.stat['records_filtered'] = len(records_filterd)
         return records_filterd
 
-    def _create_user_profiles(self, profiles, file, valid_records,
-                              ip_user=False, year=None, week=None):
-        """
-        Create user profiles with all the records visited or downloaded.
-
-        Returns: Dictionary with the user id and a record list.
-        {'2323': [1, 2, 4]}
-        """
-        for record in file.get_records():
-            recid = record[2]
-            if not valid_records.get(recid, None):
-                # Record not valid
-                continue
-
-            if ip_user:
-                ip = record[4]
-                user_agent = record[5]
-                # Generate unique user id
-                user_id = "{0}-{1}_{2}_{3}".format(year, week, ip, user_agent)
-                try:
-                    uid = hashlib.md5(user_id.encode('utf-8')).hexdigest()
-                except UnicodeDecodeError:
-                    logger.info("UnicodeDecodeError {}".format(user_id))
-            else:
-                uid = record[1]
-
-            profiles[uid].append(recid)
-
-        return profiles
-
     def _calculate_user_record_weights(self, record_list,
                                        basic_weight=0.3,
                                        max_views=20,
@@ -194,9 +311,12 @@ class Profiles(object):
         new_nodes_weight = []
         node_dict = {}
         # Count how often a record is viewed
+        if not hasattr(record_list, 'items'):
+            record_list = Counter(record_list)
         try:
-            for node_id in record_list:
-                node_dict[int(node_id)] = node_dict.get(int(node_id), 0) + 1
+            for node_id, count in iteritems(record_list):
+                node_dict[int(node_id)] = node_dict.get(int(node_id), 0) + \
+                    count
         except ValueError as e:
             logger.exception('ValuerError')
             return new_nodes, new_nodes_weight
@@ -220,3 +340,11 @@ class Profiles(object):
             new_nodes_weight.append(weight)
 
         return new_nodes, new_nodes_weight
+
+
+def _get_week_aggregate(args):
+    """Get the aggregate of a week in a worker process."""
+    storage, config, prefix, year, week, ip_user = args
+    profiles = Profiles(storage, config)
+    aggregate = profiles._get_week_aggregate(prefix, year, week, ip_user)
+    return aggregate, profiles.metrics
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Progress and throughput reporting for the recommendation build."""
+
+from __future__ import absolute_import, print_function
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class BuildProgress(object):
+    """Counters shared between the build workers and the parent process."""
+
+    def __init__(self, manager, total, slowest=5, window=100):
+        """Constructor."""
+        self.total = total
+        self.slowest = slowest
+        self.window = window
+        self.start = time.time()
+        # One entry per worker, written only by the worker itself.
+        self._state = manager.dict()
+
+    def worker(self, worker):
+        """Get the counter to be used inside a worker process."""
+        return WorkerCounter(self._state, worker, self.slowest, self.window)
+
+    def snapshot(self):
+        """Get the current state of all workers."""
+        return dict(self._state)
+
+    def summary(self, interrupted=False):
+        """Summarize the progress of the build."""
+        state = self.snapshot()
+        duration = time.time() - self.start
+        done = sum(s['done'] for s in state.values())
+        failed = sum(s['failed'] for s in state.values())
+        unwritten = sum(s['unwritten'] for s in state.values())
+        rate = done / duration if duration > 0 else 0.0
+        remaining = max(self.total - done, 0)
+        slowest = sorted((r for s in state.values() for r in s['slowest']),
+                         reverse=True)[:self.slowest]
+        workers = {}
+        for worker, s in sorted(state.items()):
+            workers[str(worker)] = {
+                'done': s['done'],
+                'failed': s['failed'],
+                'unwritten': s['unwritten'],
+                'busy': s['busy'],
+                'utilisation': s['busy'] / duration if duration > 0 else 0.0,
+            }
+        return {
+            'total': self.total,
+            'done': done,
+            'failed': failed,
+            'unwritten': unwritten,
+            'remaining': remaining,
+            'duration': duration,
+            'records_per_second': rate,
+            'eta': remaining / rate if rate > 0 else None,
+            'slowest': [{'recid': recid, 'duration': d}
+                        for d, recid in slowest],
+            'workers': workers,
+            'interrupted': interrupted,
+        }
+
+    def log(self):
+        """Log the current progress."""
+        summary = self.summary()
+        eta = summary['eta']
+        logger.info('Build progress: %s/%s records, %.2f records/s, ETA %s',
+                    summary['done'], self.total,
+                    summary['records_per_second'],
+                    '{:.0f}s'.format(eta) if eta is not None else 'unknown')
+        if summary['slowest']:
+            logger.info('Slowest recent records: %s', ', '.join(
+                '{recid} ({duration:.2f}s)'.format(**r)
+                for r in summary['slowest']))
+        if summary['workers']:
+            logger.info('Worker utilisation: %s', ', '.join(
+                '{}: {:.0%}'.format(worker, s['utilisation'])
+                for worker, s in sorted(summary['workers'].items())))
+
+    def write_summary(self, path, interrupted=False):
+        """Write the summary of the build as JSON file."""
+        summary = self.summary(interrupted)
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        return summary
+
+
+class WorkerCounter(object):
+    """Count the records built by one worker.
+
+    A record is done when its calculation failed or once its
+    recommendations were written to the store, records which could not be
+    written count as failed. The writes are accounted from the thread of
+    the writer.
+    """
+
+    def __init__(self, state, worker, slowest=5, window=100):
+        """Constructor."""
+        self._state = state
+        self.worker = worker
+        self.slowest = slowest
+        self.done = 0
+        self.failed = 0
+        self.unwritten = 0
+        self.busy = 0.0
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._publish()
+
+    def add(self, recid, duration, failed=False):
+        """Account one calculated record."""
+        with self._lock:
+            if failed:
+                self.done += 1
+                self.failed += 1
+            self.busy += duration
+            self._recent.append((duration, recid))
+            self._publish()
+
+    def add_written(self, count):
+        """Account records written to the store."""
+        with self._lock:
+            self.done += count
+            self._publish()
+
+    def add_unwritten(self, count):
+        """Account records which could not be written to the store."""
+        with self._lock:
+            self.done += count
+            self.failed += count
+            self.unwritten += count
+            self._publish()
+
+    def _publish(self):
+        """Publish the counters with a single call to the manager."""
+        self._state[self.worker] = {
+            'done': self.done,
+            'failed': self.failed,
+            'unwritten': self.unwritten,
+            'busy': self.busy,
+            'slowest': sorted(self._recent, reverse=True)[:self.slowest],
+        }
+
+
+class ProgressReporter(threading.Thread):
+    """Periodically log the progress of a build."""
+
+    def __init__(self, progress, interval=60):
+        """Constructor."""
+        super(ProgressReporter, self).__init__()
+        self.daemon = True
+        self.progress = progress
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        """Log the progress until stopped."""
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.progress.log()
+            except Exception:
+                logger.exception('Could not report the build progress')
+
+    def stop(self):
+        """Stop reporting."""
+        self._stop_event.set()
+        self.join()
@@ -31,6 +31,7 @@ from array import array
 from collections import defaultdict
 
 import networkx as nx
+import numpy as np
 import pandas as pd
 
 
@@ -53,6 +54,16 @@ class GraphRecommender(object):
         """Load user profiles from file."""
         data = self.storage.get_user_profiles(profile_name)
 
+        if hasattr(data, 'get_columns'):
+            # Binary profiles, no parsing per row needed.
+            users, recids, weights = data.get_columns()
+            self._graph.add_weighted_edges_from(
+                zip(users.tolist(), recids.tolist(), weights.tolist()))
+            records, counts = np.unique(recids, return_counts=True)
+            for recid, count in zip(records.tolist(), counts.tolist()):
+                self.all_records[recid] += count
+            return self._graph
+
         for x in data.get_user_views():
             self._graph.add_edge(int(x[0]), int(x[1]), {'weight': float(x[2])})
             self.all_records[int(x[1])] += 1
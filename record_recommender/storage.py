@@ -26,15 +26,30 @@
 
 from __future__ import absolute_import, print_function
 
+import abc
 import csv
+import hashlib
 import json
+import logging
 import os
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
 
 import numpy as np
 from redis import Redis
+from redis import exceptions as redis_exceptions
+from six import add_metaclass, iteritems
+from six.moves import queue
 
 from .utils import get_year_week
 
+logger = logging.getLogger(__name__)
+
 
 class File(object):
     """A File holding pageviews or downloads."""
@@ -77,7 +92,8 @@ class File(object):
             raise 'Close file before opening.'
 
         if mode == 'write':
-            self.file = open(self.path, 'w')
+            # Append to an existing file.
+            self.file = open(self.path, 'a')
         elif mode == 'overwrite':
             # Delete file if exist.
             self.file = open(self.path, 'w+')
@@ -103,6 +119,14 @@ class File(object):
 class RawEvents(File):
     """A File holding pageviews or downloads."""
 
+    # Column types, None for strings.
+    DTYPES = OrderedDict([('timestamp', '<f8'),
+                          ('user', '<u4'),
+                          ('recid', '<u4'),
+                          ('file_format', None),
+                          ('ip', None),
+                          ('user_agent', None)])
+
     def __init__(self, path, prefix, year, week):
         """Constructor."""
         self.year = year
@@ -110,20 +134,139 @@ class RawEvents(File):
         fields = ['timestamp', 'user', 'recid', 'file_format', 'ip',
                   'user_agent']
         self.latest_timestamp = 0
+        self.earliest_timestamp = None
         self.number_of_hits = 0
+        self.record_counts = Counter()
         super(RawEvents, self).__init__(path, prefix, fields)
 
+    def open(self, mode='read'):
+        """Open the file, ``write`` appends to an existing file."""
+        if mode == 'write':
+            self._load_statistics()
+        super(RawEvents, self).open(mode)
+
+    def _load_statistics(self):
+        """
+        Load the statistics of the stored hits before appending.
+
+        The manifest is used if it matches the file, otherwise the file is
+        read.
+        """
+        self.number_of_hits = 0
+        self.record_counts = Counter()
+        self.latest_timestamp = 0
+        self.earliest_timestamp = None
+        if not self.does_file_exist():
+            return
+        manifest = self.get_manifest()
+        if manifest.is_valid():
+            data = manifest.data
+            self.number_of_hits = data['rows']
+            self.record_counts.update(data['record_counts'])
+            self.earliest_timestamp = data['min_timestamp']
+            self.latest_timestamp = data['max_timestamp'] or 0
+            return
+        for block in self.get_blocks(['timestamp', 'recid']):
+            if not len(block['timestamp']):
+                continue
+            self.number_of_hits += len(block['timestamp'])
+            recids, counts = np.unique(block['recid'], return_counts=True)
+            self.record_counts.update(dict(zip(
+                [str(recid) for recid in recids.tolist()], counts.tolist())))
+            latest = float(block['timestamp'].max())
+            earliest = float(block['timestamp'].min())
+            if self.latest_timestamp <= latest:
+                self.latest_timestamp = latest
+            if self.earliest_timestamp is None or \
+                    self.earliest_timestamp > earliest:
+                self.earliest_timestamp = earliest
+
+    def append_file(self, other):
+        """
+        Append the events of another file of the same format.
+
+        The events are copied without parsing them, the statistics of both
+        files are merged for the next manifest.
+        """
+        self.close()
+        if not self.does_file_exist():
+            self.open('overwrite')
+            self.close()
+        other._load_statistics()
+        self._load_statistics()
+        with open(other.path, 'rb') as source:
+            self._skip_header(source)
+            with open(self.path, 'ab') as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+        self.number_of_hits += other.number_of_hits
+        self.record_counts.update(other.record_counts)
+        if other.number_of_hits:
+            self.latest_timestamp = max(self.latest_timestamp,
+                                        other.latest_timestamp)
+            if self.earliest_timestamp is None or \
+                    self.earliest_timestamp > other.earliest_timestamp:
+                self.earliest_timestamp = other.earliest_timestamp
+
+    def _skip_header(self, filep):
+        """Move behind the header of the file, if it has one."""
+        first_line = filep.readline()
+        if first_line.split(b',')[0] != self.fields[0].encode('ascii'):
+            filep.seek(0)
+
     def add_hit(self, hit):
         """Add a hit to the file."""
         if not self._csv:
             raise 'Open before write'
         self._csv.writerow(hit)
+        self._count_hit(hit)
+
+    def _count_hit(self, hit):
+        """Update the statistics of the file with a written hit."""
         self.number_of_hits += 1
+        self.record_counts[str(hit['recid'])] += 1
         # Todo: check performance for timestamp check
         # assert self._path == self.get_filename_by_timestamp(timestamp)
         timestamp = hit['timestamp']
         if self.latest_timestamp <= timestamp:
             self.latest_timestamp = timestamp
+        if self.earliest_timestamp is None or \
+                self.earliest_timestamp > timestamp:
+            self.earliest_timestamp = timestamp
+
+    def get_manifest(self):
+        """Get the manifest of the file."""
+        return WeekManifest("{}.manifest.json".format(self.path), self)
+
+    def write_manifest(self, complete=True, checkpoint=None):
+        """
+        Write the manifest with the statistics of the written hits.
+
+        :param checkpoint: Where an incomplete fetch can be continued.
+        """
+        self.close()
+        manifest = self.get_manifest()
+        manifest.save(rows=self.number_of_hits,
+                      min_timestamp=self.earliest_timestamp,
+                      max_timestamp=self.latest_timestamp or None,
+                      complete=complete,
+                      record_counts=self.record_counts,
+                      checkpoint=checkpoint)
+        return manifest
+
+    def build_manifest(self):
+        """
+        Write the manifest of a file written before manifests existed.
+
+        The statistics are read from the file, which is trusted to be
+        complete.
+        """
+        self._load_statistics()
+        return self.write_manifest(complete=True)
+
+    def delete(self):
+        """Delete the file and its manifest."""
+        super(RawEvents, self).delete()
+        self.get_manifest().delete()
 
     def get_records(self):
         """
@@ -140,6 +283,317 @@ class RawEvents(File):
             for line in filep:
                 yield line.split(',')
 
+    def get_blocks(self, columns=None, chunksize=1000000):
+        """
+        Get the columns of the CSV file in large chunks.
+
+        Only the requested columns are parsed, the string columns are
+        returned as object arrays. Rows with empty numbers in the requested
+        columns, written for events without user by older fetches, are
+        skipped.
+
+        Returns: Generator with a dictionary of arrays per chunk.
+        """
+        # Imported here as pandas slows down the start of the commands.
+        import pandas as pd
+
+        columns = columns or list(self.DTYPES)
+        self.close()
+        with open(self.path, 'r') as filep:
+            has_header = filep.readline().split(',')[0] == self.fields[0]
+        numbers = [name for name in columns if self.DTYPES[name]]
+        # The numbers are parsed as floats, which can be missing.
+        dtypes = dict((name, '<f8' if self.DTYPES[name] else object)
+                      for name in columns)
+        reader = pd.read_csv(self.path, sep=',', quotechar='|',
+                             header=0 if has_header else None,
+                             names=self.fields, usecols=columns,
+                             dtype=dtypes, keep_default_na=False,
+                             na_values=dict((name, ['']) for name in numbers),
+                             chunksize=chunksize)
+        for chunk in reader:
+            valid = chunk[numbers].notnull().all(axis=1).values
+            if not valid.all():
+                logger.warning("Skip %s rows with empty numbers in %s",
+                               len(valid) - valid.sum(), self.path)
+                chunk = chunk[valid]
+            yield dict((name, chunk[name].values.astype(self.DTYPES[name])
+                        if self.DTYPES[name] else chunk[name].values)
+                       for name in columns)
+
+    def get_columns(self, columns=None):
+        """
+        Get all stored events as columns.
+
+        Returns: Dictionary with an array per column.
+        """
+        columns = columns or list(self.DTYPES)
+        blocks = list(self.get_blocks(columns))
+        result = {}
+        for name in columns:
+            dtype = self.DTYPES[name] or object
+            result[name] = np.concatenate([b[name] for b in blocks]) \
+                if blocks else np.empty(0, dtype=dtype)
+        return result
+
+
+class ColumnarEvents(RawEvents):
+    """A compressed, columnar File holding pageviews or downloads.
+
+    The events are written in blocks. Each block starts with the size of
+    its header and the number of rows, followed by the zlib compressed
+    header (JSON with the compressed size of each column and the
+    dictionaries of the string columns) and the zlib compressed columns.
+    """
+
+    MAGIC = b'RREVNT01'
+    BLOCK = struct.Struct('<II')
+
+    def __init__(self, path, prefix, year, week, block_size=65536):
+        """Constructor."""
+        super(ColumnarEvents, self).__init__(path, prefix, year, week)
+        self.block_size = block_size
+        self._rows = None
+
+    def open(self, mode='read'):
+        """Open the file, ``write`` appends to an existing file."""
+        if self.file:
+            self.close()
+        if mode == 'write':
+            self._load_statistics()
+        if mode == 'overwrite' or (mode == 'write' and
+                                   not self.does_file_exist()):
+            self.file = open(self.path, 'w+b')
+            self.file.write(self.MAGIC)
+        elif mode == 'write':
+            self.file = open(self.path, 'ab')
+        else:
+            self.file = open(self.path, 'rb')
+        self._rows = dict((name, []) for name in self.DTYPES)
+
+    def close(self):
+        """Write the last block and close the file."""
+        if self.file:
+            if self._rows is not None:
+                self._flush()
+            self.file.close()
+        self.file = None
+        self._rows = None
+
+    def _skip_header(self, filep):
+        """Move behind the magic number of the file."""
+        if filep.read(len(self.MAGIC)) != self.MAGIC:
+            raise IOError("Wrong file format of {}".format(filep.name))
+
+    def add_hit(self, hit):
+        """Add a hit to the file."""
+        if self._rows is None:
+            raise IOError('Open before write')
+        for name, column in iteritems(self._rows):
+            column.append(hit.get(name, 0 if self.DTYPES[name] else ''))
+        self._count_hit(hit)
+        if len(self._rows['timestamp']) >= self.block_size:
+            self._flush()
+
+    def _flush(self):
+        """Write the buffered rows as one block."""
+        rows = len(self._rows['timestamp'])
+        if not rows:
+            return
+        header = {'columns': OrderedDict()}
+        buffers = []
+        for name, dtype in iteritems(self.DTYPES):
+            values = self._rows[name]
+            column = {}
+            if dtype is None:
+                # Dictionary encode the strings.
+                codes = {}
+                values = [codes.setdefault(str(value), len(codes))
+                          for value in values]
+                column['dictionary'] = sorted(codes, key=codes.get)
+                dtype = '<u4'
+            data = zlib.compress(np.asarray(values, dtype=dtype).tobytes())
+            column['size'] = len(data)
+            header['columns'][name] = column
+            buffers.append(data)
+        header = zlib.compress(json.dumps(header).encode('utf-8'))
+        self.file.write(self.BLOCK.pack(len(header), rows))
+        self.file.write(header)
+        for data in buffers:
+            self.file.write(data)
+        self._rows = dict((name, []) for name in self.DTYPES)
+
+    def get_blocks(self, columns=None):
+        """
+        Get the columns of each block.
+
+        Only the requested columns are decompressed, the string columns are
+        returned as object arrays.
+
+        Returns: Generator with a dictionary of arrays per block.
+        """
+        columns = columns or list(self.DTYPES)
+        self.close()
+        with open(self.path, 'rb') as filep:
+            if filep.read(len(self.MAGIC)) != self.MAGIC:
+                raise IOError("Wrong file format of {}".format(self.path))
+            while True:
+                block = filep.read(self.BLOCK.size)
+                if len(block) < self.BLOCK.size:
+                    break
+                header_size, rows = self.BLOCK.unpack(block)
+                header = json.loads(zlib.decompress(
+                    filep.read(header_size)).decode('utf-8'))
+                data = {}
+                for name, dtype in iteritems(self.DTYPES):
+                    column = header['columns'][name]
+                    if name not in columns:
+                        filep.seek(column['size'], os.SEEK_CUR)
+                        continue
+                    values = np.frombuffer(zlib.decompress(
+                        filep.read(column['size'])), dtype=dtype or '<u4')
+                    if dtype is None:
+                        values = np.array(column['dictionary'],
+                                          dtype=object)[values]
+                    data[name] = values
+                yield data
+
+    def get_records(self):
+        """
+        Get all stored records.
+
+        Returns: (timestamp, user, recid,...) as strings, like the CSV file.
+        """
+        for block in self.get_blocks():
+            columns = [block[name].tolist() for name in self.DTYPES]
+            for row in zip(*columns):
+                yield [str(value) for value in row]
+
+
+class WeekManifest(object):
+    """Row count, checksum and record counts of a week file."""
+
+    def __init__(self, path, source):
+        """Constructor."""
+        self.path = path
+        self.source = source
+        self._data = None
+
+    def does_file_exist(self):
+        """Check if file exist."""
+        return os.path.isfile(self.path)
+
+    @property
+    def data(self):
+        """Get the content of the manifest, None if there is none."""
+        if self._data is None and self.does_file_exist():
+            try:
+                with open(self.path, 'r') as f:
+                    self._data = json.load(f)
+            except ValueError:
+                self._data = None
+        return self._data
+
+    def save(self, rows, min_timestamp, max_timestamp, complete,
+             record_counts, checkpoint=None):
+        """Save the manifest of the week file."""
+        self._data = {'rows': rows,
+                      'min_timestamp': min_timestamp,
+                      'max_timestamp': max_timestamp,
+                      'size': os.path.getsize(self.source.path),
+                      'checksum': self.checksum(),
+                      'complete': complete,
+                      'record_counts': record_counts,
+                      'checkpoint': checkpoint}
+        with open(self.path, 'w') as f:
+            json.dump(self._data, f)
+
+    def checksum(self):
+        """Calculate the MD5 checksum of the week file."""
+        md5 = hashlib.md5()
+        with open(self.source.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    def is_valid(self, checksum=False):
+        """
+        Check that the week file matches its manifest.
+
+        Only the size is compared, unless ``checksum`` is set.
+        """
+        data = self.data
+        if not data or not self.source.does_file_exist():
+            return False
+        if os.path.getsize(self.source.path) != data['size']:
+            return False
+        return not checksum or self.checksum() == data['checksum']
+
+    def is_complete(self, checksum=False):
+        """Check that the week file is valid and was fetched completely."""
+        return self.is_valid(checksum) and bool(self.data['complete'])
+
+    def delete(self):
+        """Delete the file."""
+        self._data = None
+        if self.does_file_exist():
+            os.remove(self.path)
+
+
+class WeekAggregate(object):
+    """Cached record counts and user profiles of one week file."""
+
+    def __init__(self, path, source, ip_user=False):
+        """Constructor."""
+        self.path = path
+        self.source = source
+        self.ip_user = ip_user
+
+    def _source_signature(self):
+        """Get size and modification time of the week file."""
+        stat = os.stat(self.source.path)
+        return [stat.st_size, stat.st_mtime]
+
+    def does_file_exist(self):
+        """Check if file exist."""
+        return os.path.isfile(self.path)
+
+    def load(self):
+        """
+        Load the aggregate if it is up to date with the week file.
+
+        Returns: Tuple with the record counts and the user profiles as
+        dictionaries, or None if the aggregate has to be recomputed.
+        """
+        if not self.does_file_exist() or not self.source.does_file_exist():
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            return None
+        if data.get('source') != self._source_signature() or \
+                data.get('ip_user') != self.ip_user:
+            return None
+        return data['counts'], data['users']
+
+    def save(self, counts, users):
+        """Save the aggregate of the week file."""
+        data = {'source': self._source_signature(),
+                'ip_user': self.ip_user,
+                'counts': counts,
+                'users': users}
+        # Write to a temporary file so readers never see a partial file.
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.path)
+
+    def delete(self):
+        """Delete the file."""
+        if self.does_file_exist():
+            os.remove(self.path)
+
 
 class UserProfiles(File):
     """A File holding the raw recommendations."""
@@ -154,6 +608,11 @@ class UserProfiles(File):
         for i, node in enumerate(nodes):
             self.file.write("{},{},{}\n".format(uid, node, weights[i]))
 
+    def add_columns(self, users, recids, weights):
+        """Add the rows of many users at once from column arrays."""
+        np.savetxt(self.file, np.column_stack((users, recids, weights)),
+                   fmt='%d,%d,%s')
+
     def get_user_views(self):
         """
         Get all user views.
@@ -171,34 +630,506 @@ class UserProfiles(File):
                 yield line.split(',')
 
 
-class RedisStore(object):
-    """Redis Storage."""
+class BinaryUserProfiles(File):
+    """A binary File holding the raw recommendations.
+
+    The file starts with a 16 byte header (magic and number of rows)
+    followed by fixed-width rows of user (uint64), recid (uint32) and
+    weight (float64), it can be read without copy with ``numpy.memmap``.
+    The weights keep the precision of the CSV profiles.
+    """
+
+    MAGIC = b'RRPROF02'
+    HEADER = np.dtype([('magic', 'S8'), ('rows', '<u8')])
+    ROW = np.dtype([('user', '<u8'), ('recid', '<u4'), ('weight', '<f8')])
+
+    def __init__(self, path, prefix, buffer_size=100000):
+        """Constructor."""
+        fields = ['user', 'recid', 'score']
+        super(BinaryUserProfiles, self).__init__(path, prefix, fields)
+        self.buffer_size = buffer_size
+        self.rows = 0
+        self._buffer = []
+
+    def open(self, mode='read'):
+        """Open the file."""
+        if self.file:
+            self.close()
+        if mode == 'overwrite' or not self.does_file_exist():
+            self.file = open(self.path, 'w+b')
+            self.rows = 0
+            self._write_header()
+        else:
+            self.file = open(self.path, 'r+b')
+            self.rows = int(self._read_header()['rows'])
+            self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        """Write the buffered rows and close the file."""
+        if self.file:
+            self._flush()
+            self._write_header()
+            self.file.close()
+        self.file = None
+
+    def _write_header(self):
+        self.file.seek(0)
+        np.array([(self.MAGIC, self.rows)], dtype=self.HEADER).tofile(
+            self.file)
+        self.file.seek(0, os.SEEK_END)
+
+    def _read_header(self):
+        header = np.fromfile(self.path, dtype=self.HEADER, count=1)
+        if len(header) != 1 or header[0]['magic'] != self.MAGIC:
+            raise ValueError("Wrong file format of {}".format(self.path))
+        return header[0]
+
+    def _flush(self):
+        if self._buffer:
+            users, recids, weights = zip(*self._buffer)
+            self._buffer = []
+            self._write_rows(users, recids, weights)
+
+    def add_user(self, uid, nodes, weights):
+        """Add a user."""
+        uid = int(uid)
+        for i, node in enumerate(nodes):
+            self._buffer.append((uid, node, weights[i]))
+        if len(self._buffer) >= self.buffer_size:
+            self._flush()
+
+    def add_columns(self, users, recids, weights):
+        """Add the rows of many users at once from column arrays."""
+        # Keep the order of the users added before.
+        self._flush()
+        self._write_rows(users, recids, weights)
+
+    def _write_rows(self, users, recids, weights):
+        rows = np.empty(len(recids), dtype=self.ROW)
+        rows['user'] = users
+        rows['recid'] = recids
+        rows['weight'] = weights
+        rows.tofile(self.file)
+        self.rows += len(rows)
+
+    def get_columns(self):
+        """
+        Get the user, recid and weight columns.
+
+        Returns: Tuple with three arrays, views on a memory map of the file.
+        """
+        self.close()
+        header = self._read_header()
+        if not header['rows']:
+            rows = np.empty(0, dtype=self.ROW)
+        else:
+            rows = np.memmap(self.path, dtype=self.ROW, mode='r',
+                             offset=self.HEADER.itemsize,
+                             shape=(int(header['rows']),))
+        return rows['user'], rows['recid'], rows['weight']
+
+    def get_user_views(self):
+        """
+        Get all user views.
 
-    def __init__(self, host, port, db, prefix):
+        Returns : Generator with data as ('user', 'recid', 'score')
+                    for example (320, 5, 0.2)
+        """
+        users, recids, weights = self.get_columns()
+        for row in zip(users.tolist(), recids.tolist(), weights.tolist()):
+            yield list(row)
+
+
+class LRUCache(object):
+    """Thread-safe least recently used cache with a time to live."""
+
+    def __init__(self, size=1000, ttl=60):
         """Constructor."""
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get a key if it is cached and not expired."""
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires < time.time():
+                return default
+            # Reinsert as most recently used.
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        """Cache a value."""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove a key from the cache."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all keys from the cache."""
+        with self._lock:
+            self._data.clear()
+
+
+@add_metaclass(abc.ABCMeta)
+class RecommendationStore(object):
+    """Interface of the stores holding the calculated recommendations."""
+
+    @abc.abstractmethod
+    def get(self, key, default=None):
+        """Get a key."""
+
+    @abc.abstractmethod
+    def get_many(self, keys, default=None):
+        """Get multiple keys.
+
+        Returns: Dictionary with the requested keys and their values.
+        """
+
+    def set(self, key, value):
+        """Set a key, value pair."""
+        self.set_many({key: value})
+
+    @abc.abstractmethod
+    def set_many(self, mapping):
+        """Set multiple key, value pairs."""
+
+    @abc.abstractmethod
+    def export_raw(self, batch_size=1000):
+        """Export all pairs in batches of (key, JSON encoded value)."""
+
+    @abc.abstractmethod
+    def import_raw(self, pairs):
+        """Import (key, JSON encoded value) pairs as given by export_raw."""
+
+    def close(self):
+        """Release the resources used by the current thread."""
+
+    def copy_to(self, target, batch_size=1000):
+        """Copy all recommendations in bulk to another store.
+
+        Returns: Number of copied recommendations.
+        """
+        number = 0
+        for batch in self.export_raw(batch_size):
+            target.import_raw(batch)
+            number += len(batch)
+        return number
+
+
+class RedisStore(RecommendationStore):
+    """Redis Storage."""
+
+    def __init__(self, host, port, db, prefix, cache_size=0, cache_ttl=60,
+                 version=None):
+        """Constructor.
+
+        :param cache_size: Number of recommendations cached in process,
+            ``0`` disables the cache.
+        :param cache_ttl: Seconds a cached recommendation is valid.
+        :param version: Recommendation version, part of the cache key.
+        """
         self.prefix = prefix
+        self.version = version
         self.redis = Redis(host=host, port=port, db=db)
+        self.cache = LRUCache(cache_size, cache_ttl) if cache_size else None
+
+    def _cache_key(self, key):
+        return (self.prefix, self.version, str(key))
 
     def get(self, key, default=None):
         """Get a key."""
-        key = "{0}{1}".format(self.prefix, key)
+        if self.cache is not None:
+            data = self.cache.get(self._cache_key(key))
+            if data is not None:
+                return data
 
-        data = self.redis.get(key)
+        data = self.redis.get("{0}{1}".format(self.prefix, key))
         # Redis returns None not an exception
         if data is None:
-            data = default
-        else:
-            data = json.loads(data)
+            return default
 
+        data = json.loads(data)
+        if self.cache is not None:
+            self.cache.set(self._cache_key(key), data)
         return data
 
+    def get_many(self, keys, default=None):
+        """Get multiple keys with one round-trip.
+
+        Returns: Dictionary with the requested keys and their values.
+        """
+        keys = list(keys)
+        result = {}
+        missing = []
+        for key in keys:
+            data = None
+            if self.cache is not None:
+                data = self.cache.get(self._cache_key(key))
+            if data is None:
+                missing.append(key)
+            else:
+                result[key] = data
+
+        if missing:
+            values = self.redis.mget(["{0}{1}".format(self.prefix, key)
+                                      for key in missing])
+            for key, data in zip(missing, values):
+                if data is None:
+                    result[key] = default
+                    continue
+                data = json.loads(data)
+                if self.cache is not None:
+                    self.cache.set(self._cache_key(key), data)
+                result[key] = data
+
+        return result
+
     def set(self, key, value):
         """Set a key, value pair."""
+        if self.cache is not None:
+            self.cache.delete(self._cache_key(key))
         key = "{0}{1}".format(self.prefix, key)
 
         value = json.dumps(value, cls=NumpyEncoder)
         self.redis.set(key, value)
 
+    def set_many(self, mapping):
+        """Set multiple key, value pairs with one round-trip."""
+        pipe = self.redis.pipeline(transaction=False)
+        for key, value in mapping.items():
+            if self.cache is not None:
+                self.cache.delete(self._cache_key(key))
+            pipe.set("{0}{1}".format(self.prefix, key),
+                     json.dumps(value, cls=NumpyEncoder))
+        pipe.execute()
+
+    def export_raw(self, batch_size=1000):
+        """Export all pairs in batches of (key, JSON encoded value)."""
+        keys = []
+        for key in self.redis.scan_iter(match="{}*".format(self.prefix),
+                                        count=batch_size):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                yield self._get_raw(keys)
+                keys = []
+        if keys:
+            yield self._get_raw(keys)
+
+    def _get_raw(self, keys):
+        """Get the raw values of prefixed keys."""
+        pairs = []
+        for key, value in zip(keys, self.redis.mget(keys)):
+            if value is None:
+                continue
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            pairs.append((key[len(self.prefix):], value))
+        return pairs
+
+    def import_raw(self, pairs):
+        """Import (key, JSON encoded value) pairs as given by export_raw."""
+        pipe = self.redis.pipeline(transaction=False)
+        for key, value in pairs:
+            if self.cache is not None:
+                self.cache.delete(self._cache_key(key))
+            pipe.set("{0}{1}".format(self.prefix, key), value)
+        pipe.execute()
+
+
+class SQLiteStore(RecommendationStore):
+    """Embedded recommendation storage in a SQLite database.
+
+    The database runs in WAL mode, so readers are not blocked by a running
+    build and several build processes can write to the same file.
+    """
+
+    def __init__(self, path, prefix, timeout=60):
+        """Constructor."""
+        self.path = path
+        self.prefix = prefix
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS recommendations "
+                         "(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # The store is often used by other threads than the creating one.
+        self.close()
+
+    def _connection(self):
+        """Get the connection of the current thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Close the connection of the current thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def get(self, key, default=None):
+        """Get a key."""
+        row = self._connection().execute(
+            "SELECT value FROM recommendations WHERE key = ?",
+            ("{0}{1}".format(self.prefix, key),)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def get_many(self, keys, default=None):
+        """Get multiple keys.
+
+        Returns: Dictionary with the requested keys and their values.
+        """
+        keys = list(keys)
+        prefixed = dict(("{0}{1}".format(self.prefix, key), key)
+                        for key in keys)
+        result = dict((key, default) for key in keys)
+        names = list(prefixed)
+        conn = self._connection()
+        # Stay below the limit of variables per statement.
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            rows = conn.execute(
+                "SELECT key, value FROM recommendations WHERE key IN "
+                "({})".format(','.join('?' * len(chunk))), chunk)
+            for name, value in rows:
+                result[prefixed[name]] = json.loads(value)
+        return result
+
+    def set_many(self, mapping):
+        """Set multiple key, value pairs in one transaction."""
+        self.import_raw(
+            (key, json.dumps(value, cls=NumpyEncoder))
+            for key, value in mapping.items())
+
+    def export_raw(self, batch_size=1000):
+        """Export all pairs in batches of (key, JSON encoded value)."""
+        cursor = self._connection().execute(
+            "SELECT key, value FROM recommendations WHERE substr(key, 1, ?) "
+            "= ? ORDER BY key", (len(self.prefix), self.prefix))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [(key[len(self.prefix):], value) for key, value in rows]
+
+    def import_raw(self, pairs):
+        """Import (key, JSON encoded value) pairs in one transaction."""
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO recommendations (key, value) "
+                "VALUES (?, ?)",
+                (("{0}{1}".format(self.prefix, key), value)
+                 for key, value in pairs))
+
+
+class BackgroundWriter(threading.Thread):
+    """Write to a store in batches from a background thread.
+
+    Values are handed over through a bounded queue, :meth:`put` blocks when
+    the queue is full so the producer cannot run away from the store.
+    ``on_written`` and ``on_failed`` are called from the writer thread with
+    the number of values of every written or dropped batch.
+    """
+
+    TRANSIENT_ERRORS = (redis_exceptions.ConnectionError,
+                        redis_exceptions.TimeoutError,
+                        sqlite3.OperationalError)
+
+    def __init__(self, store, batch_size=100, queue_size=1000, retries=5,
+                 retry_wait=1.0, on_written=None, on_failed=None):
+        """Constructor."""
+        super(BackgroundWriter, self).__init__()
+        self.daemon = True
+        self.store = store
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.on_written = on_written
+        self.on_failed = on_failed
+        self.written = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop_marker = object()
+        self.start()
+
+    def put(self, key, value):
+        """Queue a key, value pair to be written."""
+        self._queue.put((key, value))
+
+    def close(self):
+        """Write all queued values and stop the thread."""
+        self._queue.put(self._stop_marker)
+        self.join()
+
+    def run(self):
+        """Write the queued values until closed."""
+        stop = False
+        try:
+            while not stop:
+                batch = {}
+                item = self._queue.get()
+                while True:
+                    if item is self._stop_marker:
+                        stop = True
+                        break
+                    key, value = item
+                    batch[key] = value
+                    if len(batch) >= self.batch_size:
+                        break
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if batch:
+                    self._write(batch)
+        finally:
+            # E.g. the SQLite connection of this thread.
+            self.store.close()
+
+    def _write(self, batch):
+        """Write one batch, retrying on transient errors."""
+        for attempt in range(self.retries + 1):
+            try:
+                self.store.set_many(batch)
+                self.written += len(batch)
+                if self.on_written:
+                    self.on_written(len(batch))
+                return
+            except self.TRANSIENT_ERRORS:
+                if attempt < self.retries:
+                    wait = self.retry_wait * 2 ** attempt
+                    logger.warning("Store not available, retry in %ss", wait)
+                    time.sleep(wait)
+                    continue
+                logger.exception("Could not write %s values", len(batch))
+            except Exception:
+                logger.exception("Could not write %s values", len(batch))
+            self.failed += len(batch)
+            if self.on_failed:
+                self.on_failed(len(batch))
+            return
+
 
 class NumpyEncoder(json.JSONEncoder):
     """Encode Numpy objects."""
@@ -228,14 +1159,23 @@ class FileStore(object):
         self.config = {
                        'base_path': 'cache/',
                        'cache_file_prefix': '',
+                       'recommendation_store': 'redis',
+                       'sqlite_path': 'recommendations.sqlite',
+                       'profile_format': 'csv',
+                       'events_format': 'csv',
                        'host': 'localhost',
                        'port': '6379',
                        'db': '0',
                        'prefix': 'Reco_1::',
+                       'cache_size': 0,
+                       'cache_ttl': 60,
+                       'recommendation_version': 0,
                       }
         if config:
             self.config.update(config.get('cache'))
             self.config.update(config.get('redis'))
+            self.config['recommendation_version'] = config.get(
+                'recommendation_version', 0)
         self.base_path = self.config['base_path']
         self.prefix = self.config['cache_file_prefix']
 
@@ -247,20 +1187,49 @@ class FileStore(object):
     def get(self, prefix, year, week):
         """Get the cache file."""
         filename = self._format_filename(prefix, year, week)
+        if self.config['events_format'] == 'columnar':
+            return ColumnarEvents(filename, prefix, year, week)
         return RawEvents(filename, prefix, year, week)
 
+    def get_week_aggregate(self, prefix, year, week, ip_user=False):
+        """Get the cached aggregate of a week file."""
+        filename = "{}{}_{}-{}.agg.json".format(self.base_path, prefix, year,
+                                                week)
+        return WeekAggregate(filename, self.get(prefix, year, week), ip_user)
+
     def get_user_profiles(self, prefix):
         """Get the user profil from the cache to the given prefix."""
         filepath = "{}{}".format(self.base_path, prefix)
+        if self.config['profile_format'] == 'binary':
+            return BinaryUserProfiles("{}.bin".format(filepath), prefix)
         return UserProfiles(filepath, prefix)
 
     def _format_filename(self, prefix, year, week):
         """Construct the file name based on the path and options."""
-        return "{}{}_{}-{}.csv".format(self.base_path, prefix, year, week)
+        extension = 'events' if self.config['events_format'] == 'columnar' \
+            else 'csv'
+        return "{}{}_{}-{}.{}".format(self.base_path, prefix, year, week,
+                                      extension)
+
+    def get_recommendation_store(self, backend=None):
+        """Get the configured recommendation store.
 
-    def get_recommendation_store(self):
-        """Get the configured recommendation store."""
+        :param backend: ``redis`` or ``sqlite``, defaults to the configured
+            ``recommendation_store``.
+        """
+        backend = backend or self.config['recommendation_store']
+        if backend == 'sqlite':
+            path = self.config['sqlite_path']
+            if not os.path.isabs(path):
+                path = "{}{}".format(self.base_path, path)
+            return SQLiteStore(path, self.config['prefix'])
+        elif backend != 'redis':
+            raise ValueError("Unknown recommendation store {}".format(
+                backend))
         return RedisStore(self.config['host'],
                           self.config['port'],
                           self.config['db'],
-                          self.config['prefix'])
+                          self.config['prefix'],
+                          cache_size=self.config['cache_size'],
+                          cache_ttl=self.config['cache_ttl'],
+                          version=self.config['recommendation_version'])
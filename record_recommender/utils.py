@@ -77,3 +77,25 @@ def get_last_weeks(number_of_weeks):
         weeks.append((n_year, n_week))
 
     return weeks
+
+
+def parse_shard(value):
+    """
+    Parse a shard definition like ``2/8``.
+
+    param value: The shard as ``index/total``, the index starting with 0.
+    returns: Tuple with the index and the total number of shards.
+    """
+    try:
+        index, total = [int(part) for part in value.split('/')]
+    except (AttributeError, ValueError):
+        raise ValueError("Shard must be given as index/total, e.g. 0/4.")
+    if total < 1 or not 0 <= index < total:
+        raise ValueError("Shard index must be between 0 and {}.".format(
+            total - 1))
+    return index, total
+
+
+def get_shard(recid, total):
+    """Get the shard index of a record."""
+    return int(recid) % total
@@ -67,6 +67,7 @@ install_requires = [
     'raven',
     'redis',
     'simplejson',
+    'six',
 ]
 
 packages = find_packages()
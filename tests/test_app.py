@@ -23,14 +23,135 @@
 # as an Intergovernmental Organization or submit itself to any jurisdiction.
 
 
+import json
+import signal
+import time
+
 from mock import patch
 
+from record_recommender import app
 from record_recommender.app import RecordRecommender, get_config, setup_logging
 
 
+class FakeRecommender(object):
+    """GraphRecommender stand-in recording the built records."""
+
+    all_records = {1: 5, 2: 50, 3: 1, 4: 20}
+    built = []
+    build_time = 0
+
+    def __init__(self, store):
+        FakeRecommender.built = []
+
+    def load_profile(self, name):
+        pass
+
+    def recommend_for_record(self, recid):
+        time.sleep(self.build_time)
+        self.built.append(recid)
+        return [recid + 1], [0.5]
+
+
+class FakeStore(object):
+    """FileStore stand-in keeping the recommendations in memory."""
+
+    broken = False
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.recommendations = {}
+
+    def get_recommendation_store(self):
+        return self
+
+    def set_many(self, values):
+        if self.broken:
+            raise ValueError('Store is broken')
+        self.recommendations.update(values)
+
+    def close(self):
+        pass
+
+
 @patch('os.path.exists', return_value=False)
 @patch('os.environ.get', return_value=None)
 def test_get_config(mock_os_exisits, mock_os_env):
     """Test admin views."""
     config = get_config(config_path=None)
     assert config == {}
+
+
+def _build(tmpdir, build_config, max_duration=None):
+    """Build the recommendations of the fake records in one process."""
+    store = FakeStore(str(tmpdir) + '/')
+    with patch('record_recommender.recommender.GraphRecommender',
+               FakeRecommender), \
+            patch('record_recommender.app._store', store):
+        summary = app._create_all_recommendations(
+            1, config={'build': build_config}, max_duration=max_duration)
+    if not store.broken:
+        assert sorted(store.recommendations) == \
+            sorted(FakeRecommender.built)
+    return summary
+
+
+def test_get_priorities(tmpdir):
+    """Test the priorities of the records."""
+    priority_file = tmpdir.join('priorities.json')
+    priority_file.write(json.dumps({'3': 10, '1': 7, '2': 1}))
+    with patch('record_recommender.app._reco', FakeRecommender(None)):
+        assert app._get_priorities({}) == FakeRecommender.all_records
+        assert app._get_priorities({'priority': 'none'}) is None
+        assert app._get_priorities({'priority_file': str(priority_file)}) \
+            == {1: 7, 2: 1, 3: 10}
+
+
+def test_build_views_priority(tmpdir):
+    """Test building the most viewed records first."""
+    summary = _build(tmpdir, {})
+    assert FakeRecommender.built == [2, 4, 1, 3]
+    assert summary['remaining'] == 0
+
+
+def test_build_priority_file(tmpdir):
+    """Test building the records in the order of a priority file."""
+    priority_file = tmpdir.join('priorities.json')
+    priority_file.write(json.dumps({'3': 10, '1': 7, '2': 1}))
+    _build(tmpdir, {'priority_file': str(priority_file)})
+    assert FakeRecommender.built == [3, 1, 2, 4]
+
+
+@patch.object(FakeRecommender, 'build_time', 0.2)
+def test_build_max_duration(tmpdir):
+    """Test stopping the workers when the time budget is spent."""
+    summary = _build(tmpdir, {}, max_duration=0.1)
+    assert FakeRecommender.built == [2]
+    assert summary['done'] == 1
+    assert summary['remaining'] == 3
+
+
+@patch.object(FakeStore, 'broken', True)
+def test_build_write_failure(tmpdir):
+    """Test that recommendations which could not be written fail."""
+    summary = _build(tmpdir, {'write_batch_size': 2})
+    assert summary['done'] == 4
+    assert summary['failed'] == 4
+    assert summary['unwritten'] == 4
+
+
+def test_build_interrupted(tmpdir):
+    """Test interrupting a build in this process."""
+    recommend = FakeRecommender.recommend_for_record
+
+    def interrupt(self, recid):
+        if recid == 4:
+            raise KeyboardInterrupt()
+        return recommend(self, recid)
+    handler = signal.getsignal(signal.SIGINT)
+    with patch.object(FakeRecommender, 'recommend_for_record', interrupt):
+        summary = _build(tmpdir, {})
+    assert summary['interrupted']
+    assert summary['done'] == 1
+    assert summary['remaining'] == 3
+    # The interrupts are only ignored by the pool workers.
+    assert signal.getsignal(signal.SIGINT) is handler
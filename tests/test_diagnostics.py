@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import json
+
+from mock import patch
+
+from record_recommender.diagnostics import StageProfiler, \
+    profile_profiles, profile_recommendations
+from record_recommender.metrics import Metrics
+from record_recommender.storage import FileStore
+
+
+def test_stage_profiler(tmpdir):
+    """Test the call statistics, memory and time of stages."""
+    path = str(tmpdir.join('report'))
+    profiler = StageProfiler(path)
+    with profiler.stage('allocate'):
+        data = [list(range(100)) for _ in range(100)]
+    assert data
+
+    report = json.load(open(profiler.write()))
+    stage = report['items']['stages'][0]
+    assert stage['name'] == 'allocate'
+    assert stage['memory_peak'] > 0
+    assert stage['top_allocations']
+    assert report['timers']['allocate'] == stage['seconds']
+    assert tmpdir.join('report', 'allocate.prof').check()
+    assert 'cumulative' in tmpdir.join('report', 'allocate.txt').read()
+
+
+@patch('record_recommender.diagnostics.GraphRecommender.recommend_for_record',
+       lambda self, recid: ([recid + 1], [0.5]))
+def test_profile_recommendations(tmpdir):
+    """Test profiling the recommendations of a sample of records."""
+    storage = FileStore({'cache': {'base_path': str(tmpdir) + '/',
+                                   'profile_format': 'binary'},
+                         'redis': {}})
+    profiles = storage.get_user_profiles('Profiles')
+    profiles.open('overwrite')
+    for user in range(10):
+        profiles.add_user(2000000000 + user, [1 + user % 3, 7], [0.6, 0.4])
+    profiles.close()
+
+    profiler = StageProfiler(str(tmpdir.join('report')), memory=False)
+    profile_recommendations(profiler, storage, sample=2, seed=1,
+                            ip_views=False)
+    records = profiler.metrics.items['records']
+    assert len(records) == 2
+    assert all(record['recommendations'] == 1 for record in records)
+    assert profiler.metrics.histogram('recommend_ms').count == 2
+    assert [stage['name'] for stage in profiler.metrics.items['stages']] == \
+        ['load_graph', 'recommend']
+
+    profiler = StageProfiler(str(tmpdir.join('report')), memory=False)
+    profile_recommendations(profiler, storage, records=[7], ip_views=False)
+    assert profiler.metrics.items['records'][0]['degree'] == 10
+
+
+def test_profile_profiles(tmpdir):
+    """Test profiling the creation of the Profiles."""
+    class FakeProfiles(object):
+        metrics = Metrics()
+
+        def create(self, weeks):
+            self.metrics.count('weeks', len(weeks))
+
+    profiler = StageProfiler(str(tmpdir), memory=False)
+    profile_profiles(profiler, FakeProfiles(), [(2016, 1), (2016, 2)])
+    assert profiler.metrics.counters['weeks'] == 2
+    assert 'profiles' in profiler.metrics.timers
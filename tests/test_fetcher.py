@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import gzip
+import io
+import json
+import threading
+
+import pytest
+import urllib3
+from mock import patch
+
+from record_recommender.fetcher import ElasticsearchFetcher, EventFilter, \
+    TransferStats, _get_counting_connection, get_event
+from record_recommender.storage import FileStore
+from record_recommender.utils import get_week_dates
+
+
+class FakeElasticsearch(object):
+    """Elasticsearch stand-in serving generated hits for each week."""
+
+    fail_on = None
+
+    def __init__(self, *args, **kwargs):
+        self.count = 5
+        self.searches = []
+        self.scroll_calls = 0
+        self.failing_scrolls = set()
+        self._scrolls = {}
+        self._lock = threading.Lock()
+
+    def ping(self):
+        return True
+
+    def search(self, index, body, size=10, **kwargs):
+        query = json.loads(body)
+        if 'slice' in query and 'filtered' in query['query']:
+            # Sliced scrolls need Elasticsearch 5 without filtered queries.
+            raise ValueError('no [query] registered for [filtered]')
+        clause = query['query'].get('filtered') or query['query']['bool']
+        query_string = clause.get('query', clause.get('must'))[
+            'query_string']['query']
+        events = [event for event in ('events.pageviews', 'events.downloads')
+                  if event in query_string]
+        if '!(id_user:0)' in query_string:
+            users = [7]
+        elif '(id_user:0)' in query_string:
+            users = [0]
+        else:
+            users = [7, 0]
+        for event in events:
+            for user in users:
+                if (event, user == 0) == self.fail_on:
+                    raise ValueError('Index not found')
+        self.searches.append((query, size))
+        time_range = clause['filter']['range']['@timestamp']
+        week_start = time_range['lt'] - 7 * 24 * 3600 * 1000
+        hits = [{'_type': event,
+                 '_id': '{}-{}-{}'.format(event, user, i),
+                 '_source': {'id_user': user,
+                             '@timestamp': week_start + 1000 * (i + 1),
+                             'id_bibrec': 100 + i,
+                             'client_host': '10.0.0.1',
+                             'user_agent': 'Mozilla',
+                             'file_format': 'PDF'}}
+                for event in events for user in users
+                for i in range(self.count)]
+        hits = [hit for hit in hits
+                if hit['_source']['@timestamp'] > time_range.get('gt', 0) and
+                hit['_source']['@timestamp'] >= time_range.get('gte', 0)]
+        if 'sort' in query and query['sort'] != ['_doc']:
+            assert query['sort'] == [{'@timestamp': 'asc'}]
+            hits.sort(key=lambda hit: hit['_source']['@timestamp'])
+        if 'slice' in query:
+            assert 'search_type' not in kwargs
+            assert query['sort'] == ['_doc']
+            hits = hits[query['slice']['id']::query['slice']['max']]
+        pages = [hits[i:i + 2] for i in range(0, len(hits), 2)]
+        # Only scan searches return no hits with the first response.
+        first_page = [] if kwargs.get('search_type') == 'scan' or \
+            not pages else pages.pop(0)
+        with self._lock:
+            scroll_id = str(len(self._scrolls))
+            self._scrolls[scroll_id] = pages
+        return {'_scroll_id': scroll_id, 'took': 1, '_shards': {'failed': 0},
+                'hits': {'total': len(hits), 'hits': first_page}}
+
+    def scroll(self, scroll_id, **kwargs):
+        with self._lock:
+            self.scroll_calls += 1
+            if self.scroll_calls in self.failing_scrolls:
+                raise IOError('Connection reset')
+            pages = self._scrolls[scroll_id]
+            page = pages.pop(0) if pages else []
+        return {'_scroll_id': scroll_id, '_shards': {'failed': 0},
+                'hits': {'hits': page}}
+
+
+@pytest.fixture(autouse=True)
+def no_resume_wait():
+    """Resume failed fetches without waiting."""
+    with patch('record_recommender.fetcher.time.sleep'):
+        yield
+
+
+@pytest.fixture
+def storage(tmpdir):
+    """File storage in a temporary directory."""
+    return FileStore({'cache': {'base_path': str(tmpdir) + '/'},
+                      'redis': {}})
+
+
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_many(storage):
+    """Test fetching weeks and streams in parallel."""
+    weeks = [(2016, 10), (2016, 11)]
+    fetcher = ElasticsearchFetcher(storage, {'elasticsearch': {}})
+    assert fetcher.fetch_many(weeks, concurrency=4) == []
+
+    for year, week in weeks:
+        start, end = get_week_dates(year, week, as_timestamp=True)
+        for prefix in ('Pageviews', 'Downloads', 'Pageviews_IP',
+                       'Downloads_IP'):
+            file = storage.get(prefix, year, week)
+            columns = file.get_columns(['timestamp', 'recid'])
+            assert columns['recid'].tolist() == [100, 101, 102, 103, 104]
+            assert start < columns['timestamp'].min() < end
+            assert file.get_manifest().is_complete()
+
+
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_many_isolates_errors(storage):
+    """Test that a failing stream does not stop the other ones."""
+    fetcher = ElasticsearchFetcher(storage, {'elasticsearch': {}})
+    fetcher._esd.fail_on = ('events.downloads', True)
+    failed = fetcher.fetch_many([(2016, 10)], concurrency=2)
+    assert failed == [(2016, 10, 'Downloads_IP')]
+    assert storage.get('Pageviews_IP', 2016, 10).does_file_exist()
+    assert storage.get('Downloads', 2016, 10).does_file_exist()
+
+
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_sliced(storage):
+    """Test fetching a week with parallel sliced scrolls."""
+    fetcher = ElasticsearchFetcher(storage,
+                                   {'elasticsearch': {'scroll_slices': 3}})
+    fetcher.fetch(2016, 10)
+    for prefix in ('Pageviews', 'Downloads', 'Pageviews_IP',
+                   'Downloads_IP'):
+        file = storage.get(prefix, 2016, 10)
+        columns = file.get_columns(['recid'])
+        assert sorted(columns['recid'].tolist()) == [100, 101, 102, 103, 104]
+        assert file.get_manifest().is_complete()
+
+
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_sliced_query(storage):
+    """Test sending the sliced scrolls as bool queries."""
+    fetcher = ElasticsearchFetcher(storage,
+                                   {'elasticsearch': {'scroll_slices': 2}})
+    fetcher.fetch_stream('Pageviews', 2016, 10)
+    start, end = get_week_dates(2016, 10, as_timestamp=True)
+    for query, size in fetcher._esd.searches:
+        assert set(query['query']) == set(['bool'])
+        assert query['query']['bool'] == {
+            'must': {'query_string': {
+                'query': '_type:events.pageviews AND !(bot:True) AND '
+                         '!(id_user:0)'}},
+            'filter': {'range': {'@timestamp': {'gt': start * 1000,
+                                                'lt': end * 1000}}}}
+    assert sorted(query['slice']['id']
+                  for query, size in fetcher._esd.searches) == [0, 1]
+
+
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_sliced_error(storage):
+    """Test that a failing slice fails the whole stream."""
+    fetcher = ElasticsearchFetcher(storage,
+                                   {'elasticsearch': {'scroll_slices': 2}})
+    fetcher._esd.fail_on = ('events.downloads', False)
+    assert fetcher.fetch_many([(2016, 10)]) == [(2016, 10, 'Downloads')]
+
+
+@pytest.mark.parametrize('overlap', [0, 3600])
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_incremental(storage, overlap):
+    """Test appending the new events of a complete week."""
+    fetcher = ElasticsearchFetcher(
+        storage, {'elasticsearch': {'incremental_overlap': overlap}})
+    fetcher.fetch(2016, 10)
+    fetcher._esd.count = 8
+    fetcher.fetch(2016, 10, incremental=True)
+
+    file = storage.get('Downloads_IP', 2016, 10)
+    columns = file.get_columns(['recid'])
+    assert columns['recid'].tolist() == list(range(100, 108))
+    manifest = file.get_manifest()
+    assert manifest.is_complete()
+    assert manifest.data['rows'] == 8
+    assert manifest.data['record_counts']['107'] == 1
+
+
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_without_manifest(storage):
+    """Test keeping week files written without manifest."""
+    fetcher = ElasticsearchFetcher(storage, {'elasticsearch': {}})
+    fetcher.fetch_stream('Downloads', 2016, 10)
+    file = storage.get('Downloads', 2016, 10)
+    file.get_manifest().delete()
+    fetcher._esd.count = 8
+    searches = len(fetcher._esd.searches)
+    fetcher.fetch_stream('Downloads', 2016, 10)
+
+    assert len(fetcher._esd.searches) == searches
+    manifest = file.get_manifest()
+    assert manifest.is_complete()
+    assert manifest.data['rows'] == 5
+    assert manifest.data['record_counts']['104'] == 1
+
+    # A file not matching its manifest is fetched again.
+    with open(file.path, 'a') as f:
+        f.write('garbage')
+    fetcher.fetch_stream('Downloads', 2016, 10)
+    assert file.get_columns(['recid'])['recid'].tolist() == \
+        list(range(100, 108))
+    assert file.get_manifest().is_complete()
+
+
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_incremental_without_manifest(storage):
+    """Test appending to week files without manifest incrementally."""
+    fetcher = ElasticsearchFetcher(
+        storage, {'elasticsearch': {'incremental_overlap': 0}})
+    fetcher.fetch(2016, 10)
+    for prefix in ('Pageviews', 'Downloads', 'Pageviews_IP',
+                   'Downloads_IP'):
+        storage.get(prefix, 2016, 10).get_manifest().delete()
+    fetcher._esd.count = 8
+    searches = len(fetcher._esd.searches)
+    assert fetcher.fetch_many([(2016, 10)], incremental=True) == []
+
+    # Only the events after the newest stored one minus the overlap.
+    start, _ = get_week_dates(2016, 10, as_timestamp=True)
+    for query, size in fetcher._esd.searches[searches:]:
+        time_range = query['query']['filtered']['filter']['range'][
+            '@timestamp']
+        assert time_range['gt'] > start * 1000
+
+    for prefix in ('Pageviews', 'Downloads', 'Pageviews_IP',
+                   'Downloads_IP'):
+        file = storage.get(prefix, 2016, 10)
+        assert file.get_columns(['recid'])['recid'].tolist() == \
+            list(range(100, 108))
+        assert file.get_manifest().is_complete()
+
+
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_lean(storage):
+    """Test fetching only the used fields with adapted page sizes."""
+    fetcher = ElasticsearchFetcher(
+        storage, {'elasticsearch': {'lean_fetch': True, 'page_size': 2000}})
+    fetcher.fetch(2016, 10)
+    searches = fetcher._esd.searches
+    assert all(query['_source'] == ElasticsearchFetcher.SOURCE_FIELDS
+               for query, size in searches)
+    # The fast responses grow the pages up to the maximum.
+    assert [size for query, size in searches] == [2000, 4000, 8000, 10000]
+    file = storage.get('Downloads', 2016, 10)
+    assert file.get_manifest().is_complete()
+
+    fetcher.config['page_target_time'] = 0
+    fetcher._adapt_page_size(pages=2, request_time=1.0, received=100)
+    assert fetcher._page_size == 5000
+
+
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_resets_transfer_stats(storage):
+    """Test reporting only the bytes of the current fetch."""
+    stats = TransferStats()
+    stats.set_week((2016, 10))
+    stats.add(received=10, decoded=40)
+    fetcher = ElasticsearchFetcher(
+        storage, {'elasticsearch': {'lean_fetch': True}})
+    with patch('record_recommender.fetcher.transfer_stats', stats):
+        fetcher.fetch(2016, 10)
+        assert stats.get(2016, 10)['requests'] == 0
+        stats.add(received=10, decoded=40)
+        fetcher.fetch_many([(2016, 10)], overwrite=True)
+        assert stats.get(2016, 10)['requests'] == 0
+
+
+def test_transfer_stats():
+    """Test counting the received bytes per week and thread."""
+    stats = TransferStats()
+    stats.set_week((2016, 10))
+    stats.add(received=10, decoded=40)
+    stats.add(received=5, decoded=20)
+
+    def other_week():
+        stats.set_week((2016, 11))
+        stats.add(received=1, decoded=1)
+    thread = threading.Thread(target=other_week)
+    thread.start()
+    thread.join()
+
+    assert stats.get(2016, 10) == {'requests': 2, 'received': 15,
+                                   'decoded': 60}
+    assert stats.get(2016, 11)['requests'] == 1
+    assert stats.thread_bytes() == 60
+
+
+class FakePool(object):
+    """Urllib3 pool stand-in answering with a gzipped body."""
+
+    def __init__(self):
+        self.headers = {}
+
+    def urlopen(self, method, url, body=None, **kwargs):
+        body = io.BytesIO()
+        with gzip.GzipFile(fileobj=body, mode='wb') as compressed:
+            compressed.write(b'{"hits": "' + b'x' * 1000 + b'"}')
+        body.seek(0)
+        return urllib3.HTTPResponse(
+            body=body, headers={'content-encoding': 'gzip'}, status=200,
+            preload_content=False)
+
+
+class FakeUrllib3HttpConnection(object):
+    """Urllib3 connection stand-in of the older Elasticsearch clients."""
+
+    def __init__(self, *args, **kwargs):
+        self.headers = {}
+        self.pool = FakePool()
+
+    def perform_request(self, method, url, params=None, body=None, **kwargs):
+        response = self.pool.urlopen(method, url, body)
+        return response.status, response.getheaders(), \
+            response.data.decode('utf-8')
+
+
+@patch('record_recommender.fetcher._counting_connection', None)
+@patch('elasticsearch.Urllib3HttpConnection', FakeUrllib3HttpConnection,
+       create=True)
+def test_counting_connection():
+    """Test requesting compressed responses and counting their bytes."""
+    stats = TransferStats()
+    connection = _get_counting_connection()(host='localhost')
+    assert 'gzip' in connection.headers['accept-encoding']
+    assert 'gzip' in connection.pool.headers['accept-encoding']
+    # The urllib3 pool itself is left untouched.
+    assert 'urlopen' not in vars(connection.pool._pool)
+
+    with patch('record_recommender.fetcher.transfer_stats', stats):
+        stats.set_week((2016, 10))
+        status, headers, data = connection.perform_request('GET', '/')
+    assert status == 200
+    received = stats.get(2016, 10)['received']
+    assert stats.get(2016, 10) == {'requests': 1, 'received': received,
+                                   'decoded': 1012}
+    assert 0 < received < 100
+
+
+def test_event_filter():
+    """Test the configurable bot and download filter."""
+    event_filter = EventFilter({'bot_patterns': ['crawler (+', 'bot.htm'],
+                                'download_patterns': ['PDF'],
+                                'cache_size': 2})
+    assert event_filter.is_bot('a crawler (+http://x)')
+    assert event_filter.is_bot('see bot.htm')
+    assert not event_filter.is_bot('Mozilla')
+    assert not event_filter.is_bot('crawler')
+    assert len(event_filter._bot_cache) <= 2
+    assert event_filter.is_download('PDF;PDFA')
+    assert event_filter.is_download('ZIP')
+    assert not event_filter.is_download('JPG')
+
+    hit = {'_source': {'id_user': 0, '@timestamp': 1500, 'id_bibrec': '12',
+                       'client_host': '10.0.0.1', 'user_agent': 'Mozilla',
+                       'file_format': 'PDF'}}
+    assert get_event(hit, event_filter, ip_users=True, downloads=True) == {
+        'user': 0, 'timestamp': 1.5, 'recid': 12, 'ip': '10.0.0.1',
+        'user_agent': 'Mozilla', 'file_format': 'PDF'}
+    hit['_source']['file_format'] = 'JPG'
+    assert get_event(hit, event_filter, ip_users=True, downloads=True) is None
+    hit['_source']['user_agent'] = 'my crawler (+http://x)'
+    assert get_event(hit, event_filter, ip_users=True) is None
+    del hit['_source']['@timestamp']
+    assert get_event(hit, event_filter, ip_users=True) is None
+    hit = {'_source': {'id_user': None, '@timestamp': 1500,
+                       'id_bibrec': 12}}
+    assert get_event(hit, event_filter) is None
+    del hit['_source']['id_user']
+    assert get_event(hit, event_filter) is None
+    assert event_filter.dropped == {'no_download': 1, 'bot': 1,
+                                    'malformed': 3}
+
+
+@pytest.mark.parametrize('concurrency', [1, 2])
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_combined(storage, concurrency):
+    """Test fetching the four streams of a week with one scroll."""
+    fetcher = ElasticsearchFetcher(
+        storage, {'elasticsearch': {'combined_fetch': True}})
+    weeks = [(2016, 10), (2016, 11)]
+    assert fetcher.fetch_many(weeks, concurrency=concurrency) == []
+    assert len(fetcher._esd.searches) == 2
+    for year, week in weeks:
+        for prefix in ('Pageviews', 'Downloads', 'Pageviews_IP',
+                       'Downloads_IP'):
+            file = storage.get(prefix, year, week)
+            columns = file.get_columns(['user', 'recid'])
+            assert columns['recid'].tolist() == [100, 101, 102, 103, 104]
+            assert set(columns['user'].tolist()) == \
+                set([0 if prefix.endswith('_IP') else 7])
+            assert file.get_manifest().is_complete()
+
+    # Only the new events are appended in incremental mode.
+    fetcher._esd.count = 6
+    fetcher.fetch(2016, 10, incremental=True)
+    file = storage.get('Downloads_IP', 2016, 10)
+    assert file.get_columns(['recid'])['recid'].tolist() == \
+        [100, 101, 102, 103, 104, 105]
+
+    fetcher._esd.fail_on = ('events.downloads', True)
+    assert fetcher.fetch_many([(2016, 12)]) == [
+        (2016, 12, prefix) for prefix in ('Pageviews', 'Downloads',
+                                          'Pageviews_IP', 'Downloads_IP')]
+
+
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_resumes(storage):
+    """Test resuming a failed scroll from the last timestamp."""
+    fetcher = ElasticsearchFetcher(storage, {'elasticsearch': {}})
+    fetcher._esd.count = 9
+    fetcher._esd.failing_scrolls = set([2, 4])
+    fetcher.fetch_stream('Downloads', 2016, 10)
+
+    file = storage.get('Downloads', 2016, 10)
+    assert file.get_columns(['recid'])['recid'].tolist() == \
+        list(range(100, 109))
+    manifest = file.get_manifest()
+    assert manifest.is_complete()
+    assert manifest.data['checkpoint'] is None
+    searches = fetcher._esd.searches
+    assert len(searches) == 3
+    assert 'gte' in searches[-1][0]['query']['filtered']['filter']['range'][
+        '@timestamp']
+
+
+@patch('record_recommender.fetcher.Elasticsearch', FakeElasticsearch)
+def test_fetch_continues_from_checkpoint(storage):
+    """Test continuing a failed fetch from the checkpoint of its file."""
+    fetcher = ElasticsearchFetcher(
+        storage, {'elasticsearch': {'resume_retries': 0}})
+    fetcher._esd.count = 9
+    fetcher._esd.failing_scrolls = set([2])
+    with pytest.raises(IOError):
+        fetcher.fetch_stream('Pageviews', 2016, 10)
+
+    file = storage.get('Pageviews', 2016, 10)
+    manifest = file.get_manifest()
+    assert not manifest.is_complete()
+    assert manifest.data['rows'] == 4
+    assert manifest.data['checkpoint']['hits'] == 4
+
+    # The next fetch continues after the checkpoint.
+    assert fetcher.fetch_many([(2016, 10)]) == []
+    query = [query for query, size in fetcher._esd.searches
+             if 'pageviews AND !(bot:True) AND !(id_user:0)' in
+             query['query']['filtered']['query']['query_string']['query']][-1]
+    time_range = query['query']['filtered']['filter']['range']['@timestamp']
+    assert time_range['gt'] == pytest.approx(
+        (manifest.data['checkpoint']['timestamp'] - 1) * 1000)
+    assert file.get_columns(['recid'])['recid'].tolist() == \
+        list(range(100, 109))
+    assert file.get_manifest().is_complete()
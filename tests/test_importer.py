@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import gzip
+import json
+
+import pytest
+from mock import patch
+
+from record_recommender.importer import EventImporter, _import_file
+from record_recommender.storage import FileStore
+from record_recommender.utils import get_week_dates, get_year_week
+
+
+def _hit(event, timestamp, user, recid, **fields):
+    source = {'@timestamp': timestamp * 1000, 'id_user': user,
+              'id_bibrec': recid, 'client_host': '10.0.0.1',
+              'user_agent': 'Mozilla', 'file_format': 'PDF'}
+    source.update(fields)
+    return json.dumps({'_type': 'events.' + event, '_source': source})
+
+
+@pytest.fixture
+def dumps(tmpdir):
+    """Two exports, one of them compressed, spanning two weeks."""
+    start_10 = get_week_dates(2016, 10, as_timestamp=True)[0] + 3600
+    start_11 = get_week_dates(2016, 11, as_timestamp=True)[0] + 3600
+    first = str(tmpdir.join('first.json'))
+    with open(first, 'w') as f:
+        f.write('\n'.join([
+            _hit('pageviews', start_10, 7, 1),
+            _hit('pageviews', start_11, 7, 2),
+            _hit('downloads', start_10, 0, 3),
+            _hit('downloads', start_10, 0, 4, file_format='JPG'),
+            _hit('pageviews', start_10, 7, 5, bot=True),
+            _hit('other', start_10, 7, 6),
+            # Without user, dropped as malformed.
+            _hit('pageviews', start_10, None, 8),
+            '{"broken',
+        ]) + '\n')
+    second = str(tmpdir.join('second.json.gz'))
+    with gzip.open(second, 'wb') as f:
+        f.write('\n'.join([
+            _hit('pageviews', start_10 + 60, 8, 9),
+            _hit('pageviews', start_11 + 60, 0, 9,
+                 user_agent='python-requests/2.0'),
+        ]).encode('utf-8'))
+    return [first, second]
+
+
+@pytest.mark.parametrize('events_format', ['csv', 'columnar'])
+@pytest.mark.parametrize('processes', [1, 2])
+def test_import_files(tmpdir, dumps, events_format, processes):
+    """Test importing exported hits into the week files."""
+    storage = FileStore({'cache': {'base_path': str(tmpdir) + '/cache/',
+                                   'events_format': events_format},
+                         'redis': {}})
+    tmpdir.mkdir('cache')
+    week_10 = get_year_week(get_week_dates(2016, 10, True)[0] + 3600)
+    week_11 = get_year_week(get_week_dates(2016, 11, True)[0] + 3600)
+    importer = EventImporter(storage, {'cache': storage.config, 'redis': {}})
+
+    imported = importer.import_files(dumps, processes=processes,
+                                     complete=True)
+    assert imported == sorted([
+        ('Downloads_IP',) + week_10, ('Pageviews',) + week_10,
+        ('Pageviews',) + week_11])
+    pageviews = storage.get('Pageviews', *week_10)
+    assert sorted(pageviews.get_columns(['recid'])['recid'].tolist()) == \
+        [1, 9]
+    manifest = pageviews.get_manifest()
+    assert manifest.is_complete()
+    assert manifest.data['rows'] == 2
+    assert not tmpdir.join('cache', 'import-parts').check()
+
+    # Replace the week files or append to them, only weeks asserted to be
+    # complete are marked complete.
+    importer.import_files(dumps[:1])
+    manifest = pageviews.get_manifest()
+    assert manifest.data['rows'] == 1
+    assert not manifest.is_complete()
+    importer.import_files(dumps[1:], append=True)
+    manifest = pageviews.get_manifest()
+    assert manifest.data['rows'] == 2
+    assert manifest.data['record_counts'] == {'1': 1, '9': 1}
+    assert manifest.is_valid(checksum=True)
+    assert not manifest.is_complete()
+    importer.import_files(dumps[1:], append=True, complete=True)
+    assert pageviews.get_manifest().is_complete()
+    importer.import_files(dumps[:1], append=True)
+    assert pageviews.get_manifest().is_complete()
+
+
+@pytest.mark.parametrize('events_format', ['csv', 'columnar'])
+def test_import_file_parts(tmpdir, events_format):
+    """Test importing into part files with a limit of open files."""
+    start_10 = get_week_dates(2016, 10, as_timestamp=True)[0] + 3600
+    start_11 = get_week_dates(2016, 11, as_timestamp=True)[0] + 3600
+    dump = tmpdir.join('dump.json')
+    dump.write('\n'.join([_hit('pageviews', start_10, 7, 1),
+                          _hit('pageviews', start_11, 7, 2),
+                          _hit('pageviews', start_10 + 60, 8, 3)]))
+    parts_path = tmpdir.join('parts', '0')
+    parts_path.ensure('stale.csv')
+    config = {'cache': {'events_format': events_format}, 'redis': {},
+              'import': {'max_open_files': 1}}
+
+    parts, _ = _import_file((config, str(dump), str(parts_path) + '/'))
+    assert not parts_path.join('stale.csv').check()
+    storage = FileStore(dict(config, cache=dict(
+        config['cache'], base_path=str(parts_path) + '/')))
+    week_10 = get_year_week(start_10)
+    assert sorted(key for key, path in parts) == sorted([
+        ('Pageviews',) + week_10, ('Pageviews',) + get_year_week(start_11)])
+    part = storage.get('Pageviews', *week_10)
+    assert part.get_columns(['recid'])['recid'].tolist() == [1, 3]
+    manifest = part.get_manifest()
+    assert manifest.is_complete()
+    assert manifest.data['record_counts'] == {'1': 1, '3': 1}
+
+
+def test_import_file_error(tmpdir, dumps):
+    """Test that a failed import leaves no complete part files."""
+    parts_path = tmpdir.join('parts')
+    config = {'cache': {}, 'redis': {}}
+    with patch('record_recommender.importer.get_event',
+               side_effect=[{'timestamp': 1457308800.0, 'recid': 1},
+                            IOError('broken')]):
+        with pytest.raises(IOError):
+            _import_file((config, dumps[0], str(parts_path) + '/'))
+    assert parts_path.listdir()
+    assert not [path for path in parts_path.listdir()
+                if path.basename.endswith('.manifest.json')]
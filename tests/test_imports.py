@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = ['IPython', 'elasticsearch', 'networkx', 'pandas']
+
+
+@pytest.mark.parametrize('module', ['record_recommender',
+                                    'record_recommender.cli',
+                                    'record_recommender.app'])
+def test_no_heavy_imports(module):
+    """Test that the heavy dependencies are only imported when needed."""
+    code = ("import json, sys; import {}; "
+            "print(json.dumps([name for name in {!r} "
+            "if name in sys.modules]))").format(module, HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert json.loads(output.decode('utf-8')) == []
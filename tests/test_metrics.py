@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+from record_recommender.metrics import Histogram, Metrics
+
+
+def test_histogram():
+    """Test the bounded histogram."""
+    histogram = Histogram()
+    for value in range(1, 101):
+        histogram.add(value)
+    histogram.add(1000, count=5)
+
+    data = histogram.to_dict()
+    assert data['count'] == 105
+    assert data['min'] == 1
+    assert data['max'] == 1000
+    assert data['p50'] == 63
+    assert data['p99'] == 1000
+    assert len(histogram.buckets) == 8
+
+
+def test_metrics_merge():
+    """Test merging the metrics of a worker."""
+    metrics = Metrics()
+    worker = Metrics()
+    metrics.count('events', 3)
+    worker.count('events', 2)
+    worker.add_time('read', 1.5)
+    worker.histogram('size').add(4)
+    worker.add_item('weeks', week=1)
+
+    metrics.merge(worker)
+    assert metrics.counters['events'] == 5
+    assert metrics.timers['read'] == 1.5
+    assert metrics.histogram('size').count == 1
+    assert metrics.to_dict()['items'] == {'weeks': [{'week': 1}]}
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+from collections import Counter, defaultdict
+
+import pytest
+
+from record_recommender.columnar import ColumnarProfiles
+from record_recommender.profiles import Profiles
+from record_recommender.storage import FileStore
+
+WEEKS = [(2016, 1), (2016, 2)]
+
+EVENTS = {
+    (2016, 1): [(1, 10), (1, 10), (1, 11), (2, 11), (2, 12), (3, 13)],
+    (2016, 2): [(1, 12), (2, 10), (3, 11), (3, 14), (4, 13), (4, 13)],
+}
+
+
+@pytest.fixture
+def storage(tmpdir):
+    """File storage with pageviews of two weeks."""
+    store = FileStore({'cache': {'base_path': str(tmpdir) + '/'},
+                       'redis': {}})
+    for (year, week), events in EVENTS.items():
+        with store.get('Pageviews', year, week) as file:
+            file.open('overwrite')
+            for i, (user, recid) in enumerate(events):
+                file.add_hit({'timestamp': 1452000000 + i, 'user': user,
+                              'recid': recid, 'ip': '127.0.0.{}'.format(user),
+                              'user_agent': 'agent'})
+            file.write_manifest()
+    return store
+
+
+def _two_pass_profiles(weeks):
+    """Reference: count all weeks first, then collect valid records."""
+    counter = defaultdict(int)
+    for week in weeks:
+        for user, recid in EVENTS[week]:
+            counter[str(recid)] += 1
+    profiles = defaultdict(Counter)
+    for week in weeks:
+        for user, recid in EVENTS[week]:
+            if counter[str(recid)] >= 2:
+                profiles[str(user)][str(recid)] += 1
+    return profiles
+
+
+def test_create_profiles_single_pass(storage):
+    """Test that the single pass gives the same profiles as two passes."""
+    profiles = Profiles(storage).create_profiles('Pageviews', WEEKS)
+    assert dict(profiles) == dict(_two_pass_profiles(WEEKS))
+    # Record 14 is viewed only once, user 3 keeps only the valid records.
+    assert profiles['3'] == Counter({'13': 1, '11': 1})
+
+
+def test_create_ip_profiles(storage):
+    """Test that ip profiles are separated per week."""
+    profiles = Profiles(storage).create_profiles('Pageviews', WEEKS,
+                                                 ip_user=True)
+    assert len(profiles) == 7
+    assert sorted(sum(records.values()) for records in profiles.values()) == \
+        [1, 1, 1, 1, 2, 2, 3]
+
+
+def test_create_profiles_cached_aggregates(storage, monkeypatch):
+    """Test that unchanged weeks are read from the cached aggregates."""
+    expected = dict(_two_pass_profiles(WEEKS))
+    assert Profiles(storage).create_profiles('Pageviews', WEEKS) == expected
+    assert storage.get_week_aggregate('Pageviews', 2016, 1).load()
+
+    # Change the newest week, only this week file is read again.
+    with storage.get('Pageviews', 2016, 2) as file:
+        file.open('overwrite')
+        for i, (user, recid) in enumerate(EVENTS[(2016, 2)][:-1]):
+            file.add_hit({'timestamp': 1452600000 + i, 'user': user,
+                          'recid': recid})
+    read = []
+    original = Profiles._read_week
+
+    def _read_week(self, file, *args, **kwargs):
+        read.append((file.year, file.week))
+        return original(self, file, *args, **kwargs)
+
+    monkeypatch.setattr(Profiles, '_read_week', _read_week)
+    profiles = Profiles(storage).create_profiles('Pageviews', WEEKS)
+    assert read == [(2016, 2)]
+    assert profiles['4'] == Counter({'13': 1})
+
+
+def test_calculate_user_record_weights():
+    """Test that record lists and counters give the same weights."""
+    profiles = Profiles(None)
+    records = ['1', '2', '1', '3', '1']
+    downloads = Counter({'3': 1})
+    assert profiles._calculate_user_record_weights(
+        records, download_list=downloads) == \
+        profiles._calculate_user_record_weights(
+            Counter(records), download_list=downloads)
+
+
+def test_create_profiles_parallel(storage):
+    """Test that parallel reading gives the same profiles and order."""
+    config = {'cache_aggregates': False}
+    sequential = Profiles(storage, config).create_profiles(
+        'Pageviews', WEEKS, ip_user=True)
+    config['workers'] = 2
+    parallel = Profiles(storage, config).create_profiles(
+        'Pageviews', WEEKS, ip_user=True)
+    assert list(parallel.items()) == list(sequential.items())
+
+
+def _exported(storage, profile_name):
+    """Get the rows of exported profiles as sorted tuples."""
+    return sorted((int(row[0]), int(row[1]), round(float(row[2]), 6))
+                  for row in storage.get_user_profiles(
+                      profile_name).get_user_views())
+
+
+def test_columnar_profiles(storage):
+    """Test that the columnar engine exports the same profiles."""
+    for ip_user in (False, True):
+        for engine in (Profiles, ColumnarProfiles):
+            profiles = engine(storage, {'cache_aggregates': False,
+                                        'user_views_min': 1})
+            views = profiles.create_profiles('Pageviews', WEEKS, ip_user)
+            downloads = profiles.create_profiles('Pageviews', WEEKS[:1],
+                                                 ip_user)
+            profiles._export_profiles(engine.__name__, views, downloads,
+                                      ip_user)
+        assert _exported(storage, 'Profiles') == \
+            _exported(storage, 'ColumnarProfiles')
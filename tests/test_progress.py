@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+from multiprocessing import Manager
+
+from record_recommender.progress import BuildProgress
+
+
+def test_build_progress_summary(tmpdir):
+    """Test the progress counters of the workers."""
+    manager = Manager()
+    progress = BuildProgress(manager, total=4, slowest=2)
+    first = progress.worker(0)
+    second = progress.worker(1)
+    first.add(1, 0.5)
+    first.add(2, 2.0, failed=True)
+    second.add(3, 1.0)
+    second.add(4, 0.1)
+    # Calculated records are done once written.
+    assert progress.summary()['done'] == 1
+    first.add_written(1)
+    second.add_unwritten(1)
+
+    path = str(tmpdir.join('report.json'))
+    summary = progress.write_summary(path)
+    assert summary['done'] == 3
+    assert summary['failed'] == 2
+    assert summary['unwritten'] == 1
+    assert summary['remaining'] == 1
+    assert [r['recid'] for r in summary['slowest']] == [2, 3]
+    assert summary['workers']['0']['busy'] == 2.5
+    assert tmpdir.join('report.json').check()
+    manager.shutdown()
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import json
+import threading
+
+import pytest
+from mock import patch
+from redis.exceptions import ConnectionError
+
+from record_recommender.storage import BackgroundWriter, \
+    BinaryUserProfiles, ColumnarEvents, LRUCache, RawEvents, \
+    RecommendationStore, RedisStore, SQLiteStore
+
+
+class FakeRedis(object):
+    """Minimal in-memory stand-in for the Redis client."""
+
+    def __init__(self, *args, **kwargs):
+        self.data = {}
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append(('get', key))
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self.calls.append(('mget', keys))
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value):
+        self.data[key] = value
+
+
+@patch('record_recommender.storage.Redis', FakeRedis)
+def test_redis_store_get_many():
+    """Test reading multiple recommendations with one round-trip."""
+    store = RedisStore('localhost', 6379, 0, 'Reco::', cache_size=10,
+                       version=2)
+    store.set(1, {'records': [2, 3], 'version': 2})
+    store.set(2, {'records': [1], 'version': 2})
+
+    assert store.get_many([1, 2, 3], default={}) == {
+        1: {'records': [2, 3], 'version': 2},
+        2: {'records': [1], 'version': 2},
+        3: {},
+    }
+    assert store.redis.calls == [('mget', ['Reco::1', 'Reco::2', 'Reco::3'])]
+
+    # Cached values need no round-trip.
+    assert store.get(1) == {'records': [2, 3], 'version': 2}
+    assert store.get_many([2])[2] == {'records': [1], 'version': 2}
+    assert len(store.redis.calls) == 1
+
+    # Writing invalidates the cached value.
+    store.set(1, {'records': [4], 'version': 2})
+    assert store.get(1) == {'records': [4], 'version': 2}
+    assert json.loads(store.redis.data['Reco::1'])['records'] == [4]
+
+
+def test_lru_cache():
+    """Test eviction and expiry of the LRU cache."""
+    cache = LRUCache(size=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+    expired = LRUCache(size=2, ttl=-1)
+    expired.set('a', 1)
+    assert expired.get('a', 'missing') == 'missing'
+
+
+class FlakyStore(object):
+    """Store failing the first writes with a connection error."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.batches = []
+        self.closed_by = None
+
+    def set_many(self, mapping):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError()
+        self.batches.append(dict(mapping))
+
+    def close(self):
+        self.closed_by = threading.current_thread()
+
+
+def test_background_writer_batches_and_retries():
+    """Test that the writer batches values and retries transient errors."""
+    store = FlakyStore(failures=2)
+    written = []
+    writer = BackgroundWriter(store, batch_size=3, queue_size=10,
+                              retries=2, retry_wait=0,
+                              on_written=written.append)
+    for i in range(7):
+        writer.put(i, {'records': [i]})
+    writer.close()
+
+    assert writer.written == 7
+    assert sum(written) == 7
+    # The store is closed by the thread of the writer.
+    assert store.closed_by is writer
+    assert writer.failed == 0
+    assert all(len(batch) <= 3 for batch in store.batches)
+    written = {}
+    for batch in store.batches:
+        written.update(batch)
+    assert sorted(written) == list(range(7))
+
+
+def test_background_writer_gives_up():
+    """Test that a batch is dropped after the last retry."""
+    store = FlakyStore(failures=10)
+    failed = []
+    writer = BackgroundWriter(store, batch_size=5, retries=1, retry_wait=0,
+                              on_failed=failed.append)
+    writer.put(1, {})
+    writer.close()
+    assert writer.written == 0
+    assert writer.failed == 1
+    assert failed == [1]
+
+
+def test_recommendation_store_interface():
+    """Test that the stores have to implement the interface."""
+    with pytest.raises(TypeError):
+        RecommendationStore()
+
+    class IncompleteStore(RecommendationStore):
+        def get(self, key, default=None):
+            return default
+
+    with pytest.raises(TypeError):
+        IncompleteStore()
+
+
+def test_sqlite_store(tmpdir):
+    """Test the embedded recommendation store."""
+    path = str(tmpdir.join('recommendations.sqlite'))
+    store = SQLiteStore(path, 'Reco::')
+    closed = []
+    close = SQLiteStore.close
+
+    def closing(self):
+        closed.append(threading.current_thread())
+        close(self)
+    with patch.object(SQLiteStore, 'close', closing):
+        writer = BackgroundWriter(store, batch_size=2)
+        for i in range(5):
+            writer.put(i, {'records': [i, i + 1], 'version': 1})
+        writer.close()
+    assert writer.written == 5
+    # The writer closes the connection of its thread.
+    assert closed == [writer]
+
+    assert store.get(1) == {'records': [1, 2], 'version': 1}
+    assert store.get(9, {}) == {}
+    assert store.get_many([0, 4, 9]) == {
+        0: {'records': [0, 1], 'version': 1},
+        4: {'records': [4, 5], 'version': 1},
+        9: None,
+    }
+
+    # Other prefixes are neither read nor exported.
+    other = SQLiteStore(path, 'Other::')
+    other.set(1, {'records': []})
+    assert store.get(1) == {'records': [1, 2], 'version': 1}
+
+    target = SQLiteStore(str(tmpdir.join('copy.sqlite')), 'Reco::')
+    assert store.copy_to(target, batch_size=2) == 5
+    assert target.get_many(range(5)) == store.get_many(range(5))
+
+
+def test_binary_user_profiles(tmpdir):
+    """Test writing and memory mapping binary profiles."""
+    path = str(tmpdir.join('Profiles.bin'))
+    with BinaryUserProfiles(path, 'Profiles', buffer_size=10) as profiles:
+        profiles.clear()
+        profiles.add_user('100000000001', [5, 6, 7], [0.3, 0.5, 0.25])
+        # The buffered user is written first.
+        profiles.add_columns([500000000000, 500000000000], [5, 8],
+                             [0.3, 0.75])
+        profiles.add_user('100000000003', [4], [1.0 / 3])
+
+    profiles = BinaryUserProfiles(path, 'Profiles')
+    users, recids, weights = profiles.get_columns()
+    assert users.tolist() == [100000000001] * 3 + [500000000000] * 2 + \
+        [100000000003]
+    assert recids.tolist() == [5, 6, 7, 5, 8, 4]
+    # The weights are as precise as in the CSV profiles.
+    assert weights.tolist() == [0.3, 0.5, 0.25, 0.3, 0.75, 1.0 / 3]
+    assert list(profiles.get_user_views())[-1] == [100000000003, 4, 1.0 / 3]
+
+    # Append to an existing file.
+    profiles.open('write')
+    profiles.add_user(100000000002, [9], [0.5])
+    profiles.close()
+    assert BinaryUserProfiles(path, 'Profiles').get_columns()[1].tolist() \
+        == [5, 6, 7, 5, 8, 4, 9]
+
+
+HITS = [
+    {'timestamp': 1452000000.5, 'user': 0, 'recid': 12, 'ip': '10.0.0.1',
+     'user_agent': 'Mozilla/5.0 (X11, Linux)'},
+    {'timestamp': 1452000001.25, 'user': 3, 'recid': 13,
+     'file_format': 'PDF'},
+    {'timestamp': 1452000002.0, 'user': 0, 'recid': 12, 'ip': '10.0.0.1',
+     'user_agent': 'Mozilla/5.0 (X11, Linux)'},
+]
+
+
+def test_columnar_events(tmpdir):
+    """Test writing and reading the columnar week cache."""
+    path = str(tmpdir.join('Pageviews_2016-1.events'))
+    events = ColumnarEvents(path, 'Pageviews', 2016, 1, block_size=2)
+    events.open('overwrite')
+    for hit in HITS[:2]:
+        events.add_hit(hit)
+    events.close()
+    # Append a block to the existing file.
+    events.open('write')
+    events.add_hit(HITS[2])
+    events.close()
+    assert events.number_of_hits == 3
+    assert events.latest_timestamp == 1452000002.0
+
+    columns = events.get_columns(['recid', 'user_agent'])
+    assert sorted(columns) == ['recid', 'user_agent']
+    assert columns['recid'].dtype.name == 'uint32'
+    assert columns['recid'].tolist() == [12, 13, 12]
+    assert columns['user_agent'].tolist() == [
+        'Mozilla/5.0 (X11, Linux)', '', 'Mozilla/5.0 (X11, Linux)']
+    assert events.get_columns()['timestamp'].tolist() == [
+        1452000000.5, 1452000001.25, 1452000002.0]
+    assert list(events.get_records())[1] == [
+        '1452000001.25', '3', '13', 'PDF', '', '']
+
+
+def test_raw_events_columns(tmpdir):
+    """Test the bulk column reader of the CSV week cache."""
+    path = str(tmpdir.join('Pageviews_2016-1.csv'))
+    events = RawEvents(path, 'Pageviews', 2016, 1)
+    events.open('overwrite')
+    for hit in HITS:
+        events.add_hit(hit)
+    events.close()
+
+    blocks = list(events.get_blocks(['user', 'user_agent'], chunksize=2))
+    assert len(blocks) == 2
+    assert sorted(blocks[0]) == ['user', 'user_agent']
+
+    columns = events.get_columns(['recid', 'user_agent'])
+    assert columns['recid'].dtype.name == 'uint32'
+    assert columns['recid'].tolist() == [12, 13, 12]
+    # Quoted user agents with commas are read completely.
+    assert columns['user_agent'].tolist() == [
+        'Mozilla/5.0 (X11, Linux)', '', 'Mozilla/5.0 (X11, Linux)']
+
+    # Events without user of older fetches are skipped.
+    events = RawEvents(path, 'Pageviews', 2016, 1)
+    events.open('write')
+    events.add_hit(dict(HITS[0], user=None, recid=14))
+    events.close()
+    columns = events.get_columns(['user', 'recid'])
+    assert columns['user'].dtype.name == 'uint32'
+    assert columns['recid'].tolist() == [12, 13, 12]
+    assert events.get_columns(['recid'])['recid'].tolist() == \
+        [12, 13, 12, 14]
+
+
+def test_week_manifest(tmpdir):
+    """Test the manifest of a week file."""
+    for cls in (RawEvents, ColumnarEvents):
+        path = str(tmpdir.join('Pageviews_2016-1.{}'.format(cls.__name__)))
+        events = cls(path, 'Pageviews', 2016, 1)
+        events.open('overwrite')
+        for hit in HITS:
+            events.add_hit(hit)
+        manifest = events.write_manifest(complete=False)
+
+        manifest = cls(path, 'Pageviews', 2016, 1).get_manifest()
+        assert manifest.data['rows'] == 3
+        assert manifest.data['min_timestamp'] == 1452000000.5
+        assert manifest.data['max_timestamp'] == 1452000002.0
+        assert manifest.data['record_counts'] == {'12': 2, '13': 1}
+        assert manifest.is_valid(checksum=True)
+        assert not manifest.is_complete()
+
+        with open(path, 'ab') as f:
+            f.write(b'garbage')
+        assert not manifest.is_valid()
+
+        events.delete()
+        assert not manifest.does_file_exist()
+
+
+def test_raw_events_append(tmpdir):
+    """Test appending to a week file with and without manifest."""
+    path = str(tmpdir.join('Pageviews_2016-1.csv'))
+    events = RawEvents(path, 'Pageviews', 2016, 1)
+    events.open('overwrite')
+    events.add_hit({'timestamp': 10.5, 'user': 1, 'recid': 5})
+    events.write_manifest()
+
+    # The statistics are loaded from the manifest.
+    events = RawEvents(path, 'Pageviews', 2016, 1)
+    events.open('write')
+    events.add_hit({'timestamp': 11.5, 'user': 2, 'recid': 5})
+    assert events.write_manifest().data['rows'] == 2
+
+    # Or read from the file.
+    events.get_manifest().delete()
+    events = RawEvents(path, 'Pageviews', 2016, 1)
+    events.open('write')
+    events.add_hit({'timestamp': 9.5, 'user': 3, 'recid': 6})
+    data = events.write_manifest().data
+    assert data['rows'] == 3
+    assert data['min_timestamp'] == 9.5
+    assert data['max_timestamp'] == 11.5
+    assert data['record_counts'] == {'5': 2, '6': 1}
+    assert events.get_columns(['user'])['user'].tolist() == [1, 2, 3]
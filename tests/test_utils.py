@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of CERN Document Server.
+# Copyright (C) 2016 CERN.
+#
+# CERN Document Server is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# CERN Document Server is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CERN Document Server; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+import pytest
+
+from record_recommender.utils import get_shard, parse_shard
+
+
+def test_parse_shard():
+    """Test parsing of the shard option."""
+    assert parse_shard('0/4') == (0, 4)
+    assert parse_shard('3/4') == (3, 4)
+    for value in ('4/4', '-1/4', '1', 'a/b', '0/0'):
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def test_get_shard_partition():
+    """Test that the shards partition all records."""
+    records = range(1, 1000)
+    shards = [set(r for r in records if get_shard(r, 3) == i)
+              for i in range(3)]
+    assert set.union(*shards) == set(records)
+    assert sum(len(shard) for shard in shards) == len(records)